@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_webui import noise_png
+from starrysky import HttpxTransport, RequestsTransport, StarrySky
+
+# /progress poll latency while large img2img uploads are in flight, for the
+# requests/aiohttp transport and HttpxTransport over HTTP/1.1 and HTTP/2.
+# Needs httpx[http2] and hypercorn; HTTP/2 needs TLS, e.g. a self-signed cert:
+#
+#   openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=localhost \
+#       -keyout key.pem -out cert.pem -addext "subjectAltName=IP:127.0.0.1"
+#   python benchmarks/bench_http2.py --certfile cert.pem --keyfile key.pem
+
+IMAGE = noise_png(64)
+
+
+class MockApp:
+    # ASGI stand-in for the webui API; counts client connections and protocols
+    def __init__(self, latency):
+        self.latency = latency
+        self.connections = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                else:
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        self.connections.add((tuple(scope["client"]), scope["http_version"]))
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        path = scope["path"]
+        if path.endswith("/img2img"):
+            await asyncio.sleep(self.latency)
+            seed = json.loads(body).get("seed", -1)
+            out = {"images": [IMAGE], "parameters": {}, "info": json.dumps({"seed": seed})}
+        elif path.endswith("/scripts"):
+            out = {"txt2img": [], "img2img": []}
+        else:
+            out = {"progress": 0.5, "eta_relative": 1.0, "state": {}, "current_image": None}
+        data = json.dumps(out).encode()
+        headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(data)).encode()),
+        ]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": data})
+
+    def take_connections(self):
+        # -> (connections, protocols) since the last call
+        connections, self.connections = self.connections, set()
+        return len(connections), sorted({version for _, version in connections})
+
+
+def serve(app, port, certfile, keyfile):
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.certfile = certfile
+    config.keyfile = keyfile
+    config.loglevel = "WARNING"
+    # no GOAWAY after 1000 requests: httpcore fails the requests in flight on
+    # a connection the server retires, which would end the sync runs early
+    config.keep_alive_max_requests = 1 << 30
+    # runs until the process exits; signal handlers only work in the main thread
+    forever = lambda: asyncio.get_running_loop().create_future()
+    server = hypercorn_serve(app, config, shutdown_trigger=forever)
+    threading.Thread(target=asyncio.run, args=(server,), daemon=True).start()
+
+
+def make_api(kind, baseurl, certfile):
+    if kind == "requests":
+        transport = RequestsTransport()
+    else:
+        transport = HttpxTransport(
+            http2=kind != "httpx-h1",
+            http1_upload_threshold=None if kind == "httpx-h2-all" else 512 * 1024,
+            verify=certfile,
+        )
+    return StarrySky(baseurl=baseurl, token="bench", transport=transport)
+
+
+def sync_bench(api, upload, args):
+    latencies = []
+    lock = threading.Lock()
+
+    def poll():
+        for _ in range(args.polls):
+            start = time.perf_counter()
+            api.get_progress()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.uploads + args.pollers) as executor:
+        uploads = [
+            executor.submit(api.img2img, images=[upload], seed=i)
+            for i in range(args.uploads)
+        ]
+        time.sleep(0.2)  # uploads in flight
+        polls = [executor.submit(poll) for _ in range(args.pollers)]
+        for future in uploads + polls:
+            future.result()
+    api.transport.close()
+    return time.perf_counter() - start, latencies
+
+
+async def async_bench(api, upload, args):
+    latencies = []
+
+    async def poll():
+        for _ in range(args.polls):
+            start = time.perf_counter()
+            await api.transport.aget(f"{api.baseurl}/progress")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    uploads = [
+        api.img2img(images=[upload], seed=i, use_async=True) for i in range(args.uploads)
+    ]
+    await asyncio.sleep(0.2)
+    await asyncio.gather(*uploads, *(poll() for _ in range(args.pollers)))
+    if hasattr(api.transport, "aclose"):
+        await api.transport.aclose()
+    return time.perf_counter() - start, latencies
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--certfile", required=True)
+    parser.add_argument("--keyfile", required=True)
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--uploads", type=int, default=16)
+    parser.add_argument("--upload-mb", type=float, default=3, help="raw image bytes")
+    parser.add_argument("--latency", type=float, default=1.0, help="mock seconds per job")
+    parser.add_argument("--pollers", type=int, default=8)
+    parser.add_argument("--polls", type=int, default=50)
+    parser.add_argument(
+        "kinds",
+        nargs="*",
+        default=["requests", "httpx-h1", "httpx-h2", "httpx-h2-all"],
+        help="requests, httpx-h1, httpx-h2, httpx-h2-all (uploads over HTTP/2 too)",
+    )
+    args = parser.parse_args()
+
+    # requests and aiohttp read the CA bundle from the environment
+    os.environ["REQUESTS_CA_BUNDLE"] = os.environ["SSL_CERT_FILE"] = args.certfile
+    app = MockApp(args.latency)
+    serve(app, args.port, args.certfile, args.keyfile)
+    baseurl = f"https://127.0.0.1:{args.port}/sdapi/v1"
+    upload = os.urandom(int(args.upload_mb * 1024 * 1024))
+    time.sleep(1.0)  # server startup
+
+    print(
+        f"{args.uploads} x {args.upload_mb:g}MB img2img uploads ({args.latency:g}s each) + "
+        f"{args.pollers} x {args.polls} /progress polls"
+    )
+    print(f"{'transport':26} {'seconds':>7} {'poll p50':>9} {'poll p99':>9} {'conns':>6}  protocols")
+    for kind in args.kinds:
+        for mode in ("sync", "async"):
+            api = make_api(kind, baseurl, args.certfile)
+            app.take_connections()
+            name = f"{kind}{' (aiohttp)' if kind == 'requests' and mode == 'async' else ''} {mode}"
+            try:
+                if mode == "sync":
+                    elapsed, latencies = sync_bench(api, upload, args)
+                else:
+                    elapsed, latencies = asyncio.run(async_bench(api, upload, args))
+            except Exception as e:
+                # reported instead of ending the run, e.g. a connection the
+                # server terminated with requests in flight
+                print(f"{name:26} failed: {type(e).__name__}: {e}")
+                continue
+            connections, protocols = app.take_connections()
+            print(
+                f"{name:26} {elapsed:7.2f} {percentile(latencies, 0.5):7.1f}ms "
+                f"{percentile(latencies, 0.99):7.1f}ms {connections:6}  {','.join(protocols)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_webui import MockWebui
+from starrysky import StarrySky
+
+# Event loop lag while async results are decoded, against a local mock:
+#
+#   python benchmarks/bench_loop_lag.py --image-size 1024 --batch-size 4
+#
+# A ticker task sleeps for 1 ms in a loop; lag is how late it wakes up. Large
+# results decoded on the loop (inline) stall every other task meanwhile.
+
+TICK = 0.001
+
+
+async def ticker(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def run(api, requests, concurrency, batch_size):
+    lags = []
+    stop = asyncio.Event()
+    tick_task = asyncio.create_task(ticker(lags, stop))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(seed):
+        async with semaphore:
+            return await api.txt2img(
+                prompt="bench", seed=seed, batch_size=batch_size, use_async=True
+            )
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await tick_task
+    assert all(len(r.images) == batch_size for r in results)
+    return elapsed, sorted(lags)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="mock seconds per job")
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4, help="decode pool size")
+    args = parser.parse_args()
+
+    server = MockWebui(latency=args.latency, image_size=args.image_size).start()
+    modes = [
+        ("inline", None, float("inf")),
+        ("thread", ThreadPoolExecutor(args.workers), 0),
+        ("process", ProcessPoolExecutor(args.workers), 0),
+    ]
+    print(
+        f"{args.requests} async txt2img requests, {args.batch_size} x "
+        f"{args.image_size}px images each, {args.concurrency} in flight"
+    )
+    print(f"{'decode':>8} {'seconds':>8} {'lag p50':>8} {'lag p99':>8} {'lag max':>8}")
+    for name, executor, threshold in modes:
+        api = StarrySky(
+            baseurl=server.baseurl,
+            token="bench",
+            decode_executor=executor,
+            decode_offload_threshold=threshold,
+        )
+        elapsed, lags = asyncio.run(
+            run(api, args.requests, args.concurrency, args.batch_size)
+        )
+        p50, p99 = (lags[min(len(lags) - 1, int(q * len(lags)))] for q in (0.5, 0.99))
+        print(
+            f"{name:>8} {elapsed:8.2f} {p50 * 1000:6.1f}ms {p99 * 1000:6.1f}ms "
+            f"{lags[-1] * 1000:6.1f}ms"
+        )
+        if executor is not None:
+            executor.shutdown()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
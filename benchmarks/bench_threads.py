@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_webui import MockWebui
+from starrysky import StarrySky
+
+# Throughput of one StarrySky shared by a thread pool, against a local mock:
+#
+#   python benchmarks/bench_threads.py --threads 1 2 4 8 16 32 --latency 0.05
+
+
+def run(api, threads, requests):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(
+            executor.map(lambda i: api.txt2img(prompt="bench", seed=i), range(requests))
+        )
+    elapsed = time.perf_counter() - start
+    assert [r.info["seed"] for r in results] == list(range(requests))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.05, help="mock seconds per job")
+    parser.add_argument("--image-size", type=int, default=64)
+    args = parser.parse_args()
+
+    server = MockWebui(latency=args.latency, image_size=args.image_size).start()
+    print(f"{args.requests} txt2img requests, {args.latency * 1000:.0f} ms mock latency")
+    print(f"{'threads':>7} {'seconds':>8} {'req/s':>8} {'speedup':>8}")
+    base = None
+    for threads in args.threads:
+        api = StarrySky(
+            baseurl=server.baseurl, token="bench", pool_maxsize=threads, pool_block=True
+        )
+        elapsed = run(api, threads, args.requests)
+        rate = args.requests / elapsed
+        base = base or rate
+        print(f"{threads:>7} {elapsed:8.2f} {rate:8.1f} {rate / base:7.1f}x")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_webui import MockWebui
+from starrysky import CancelToken, RateLimit, RateLimiter, RequestCancelled, StarrySky
+
+# Cancellation regression checks against a local mock; exits non-zero on failure:
+#
+#   python benchmarks/check_cancel.py
+
+
+def check_ratelimit_cancel_during_delay():
+    # tasks cancelled while waiting out the requests/sec delay must give back
+    # their max_concurrent slots
+    server = MockWebui(latency=0.05).start()
+    limiter = RateLimiter(
+        per_baseurl=RateLimit(requests_per_second=1, burst=1, max_concurrent=2)
+    )
+    api = StarrySky(baseurl=server.baseurl, token="check", rate_limiter=limiter)
+    (bucket,) = limiter.buckets(server.baseurl)
+
+    async def run():
+        await api.txt2img(prompt="check", use_async=True)  # uses up the burst
+        tasks = [api.txt2img(prompt="check", use_async=True) for _ in range(2)]
+        await asyncio.sleep(0.2)
+        assert bucket.active == 2, bucket.active
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert bucket.active == 0, f"{bucket.active} slots leaked"
+        await asyncio.wait_for(api.txt2img(prompt="check", use_async=True), 10)
+
+    asyncio.run(run())
+    server.shutdown()
+
+
+def check_sync_cancel_without_interrupt():
+    # a cancelled blocking call returns at once even when the backend job
+    # can't be interrupted (no /internal/progress to confirm the task)
+    server = MockWebui(latency=2.0, internal_progress=False).start()
+    api = StarrySky(baseurl=server.baseurl, token="check")
+    token = CancelToken()
+    threading.Timer(0.2, token.cancel).start()
+    start = time.monotonic()
+    try:
+        api.txt2img(prompt="check", cancel_token=token)
+        raise AssertionError("no RequestCancelled")
+    except RequestCancelled:
+        pass
+    elapsed = time.monotonic() - start
+    assert elapsed < 0.5, f"returned after {elapsed:.2f}s"
+    server.shutdown()
+
+
+CHECKS = [check_ratelimit_cancel_during_delay, check_sync_cancel_without_interrupt]
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        start = time.monotonic()
+        try:
+            check()
+            print(f"ok     {check.__name__} ({time.monotonic() - start:.2f}s)")
+        except Exception as e:
+            failed += 1
+            print(f"FAILED {check.__name__}: {type(e).__name__}: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
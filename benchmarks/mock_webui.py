@@ -0,0 +1,136 @@
+import argparse
+import base64
+import io
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+# Minimal stand-in for the webui API, for benchmarks without a GPU:
+#
+#   python benchmarks/mock_webui.py --latency 0.05 --image-size 512
+#
+# txt2img/img2img/extras sleep for --latency seconds (until interrupted) and
+# return batch_size copies of a noise PNG, so response sizes are realistic.
+
+
+def noise_png(size) -> str:
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    with io.BytesIO() as output:
+        image.save(output, format="PNG", compress_level=1)
+        return base64.b64encode(output.getvalue()).decode()
+
+
+class MockWebui(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        latency=0.05,
+        image_size=64,
+        internal_progress=True,  # False: 404 like webui versions without it
+    ):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.internal_progress = internal_progress
+        self.image = noise_png(image_size)
+        self.active = {}  # task id -> interrupted
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.interrupts = 0
+
+    @property
+    def baseurl(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/sdapi/v1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        server = self.server
+        if self.path.endswith("/scripts"):
+            return self._send({"txt2img": [], "img2img": []})
+        if self.path.endswith("/progress"):
+            with server.lock:
+                jobs = len(server.active)
+            return self._send(
+                {
+                    "progress": 0.5 if jobs else 0.0,
+                    "eta_relative": 1.0,
+                    "state": {"job_count": jobs},
+                    "current_image": None,
+                }
+            )
+        self._send({})
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.path == "/internal/progress":
+            if not server.internal_progress:
+                return self._send({"detail": "Not Found"}, 404)
+            with server.lock:
+                active = payload.get("id_task") in server.active
+            return self._send({"active": active, "queued": False, "completed": False})
+        if self.path.endswith("/interrupt"):
+            with server.lock:
+                server.interrupts += 1
+                for task_id in server.active:
+                    server.active[task_id] = True
+            return self._send({})
+
+        task_id = payload.get("force_task_id") or object()
+        with server.lock:
+            server.requests += 1
+            server.active[task_id] = False
+        deadline = time.monotonic() + server.latency
+        while time.monotonic() < deadline and not server.active[task_id]:
+            time.sleep(min(0.005, server.latency))
+        with server.lock:
+            del server.active[task_id]
+
+        count = payload.get("batch_size", 1)
+        if self.path.endswith("/extra-batch-images"):
+            count = len(payload.get("imageList", []))
+        seed = payload.get("seed", -1)
+        info = {"seed": seed, "all_seeds": [seed + i for i in range(count)]}
+        if self.path.endswith("/extra-single-image"):
+            return self._send({"image": server.image, "html_info": ""})
+        self._send(
+            {"images": [server.image] * count, "parameters": payload, "info": json.dumps(info)}
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock webui API server")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per job")
+    parser.add_argument("--image-size", type=int, default=64, help="PNG width/height")
+    args = parser.parse_args()
+    server = MockWebui(("127.0.0.1", args.port), args.latency, args.image_size)
+    print(server.baseurl)
+    server.serve_forever()
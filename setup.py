@@ -22,6 +22,9 @@ setup(
     python_requires=">=3.7, <4",
     install_requires=['requests',
                       'Pillow',],
+    entry_points={
+        "console_scripts": ["starrysky=starrysky.cli:main"],
+    },
     long_description=long_description,
     long_description_content_type='text/markdown',
     license="MIT",
@@ -1,15 +1,56 @@
 from .starrysky import (
     StarrySky,
     StarrySkyResult,
+    PreviewFrame,
     Upscaler,
     HiResUpscaler,
     b64_img,
     raw_b64_img,
+    decode_b64_into,
+    BufferPool,
     ModelKeywordResult,
     ModelKeywordInterface,
     InstructPix2PixInterface,
     ControlNetInterface,
     ControlNetUnit,
+    CancelToken,
+    RequestCancelled,
+    fix_seed,
+)
+from .pnginfo import (
+    read_png_text,
+    parse_generation_parameters,
+    read_generation_parameters,
+    scan_png_info,
+)
+from .ratelimit import (
+    RateLimit,
+    RateLimiter,
+)
+from .replay import (
+    TrafficArchive,
+    RecordingAdapter,
+    ReplayAdapter,
+)
+from .archive import ResultArchive
+from .transport import (
+    Transport,
+    RequestsTransport,
+    HttpxTransport,
+)
+from .admission import (
+    AdmissionController,
+    merge_results,
+)
+from .pipeline import (
+    BackendScheduler,
+    FramePipeline,
+    Candidate,
+    PreviewRefinePipeline,
+)
+from .hedging import (
+    HedgedClient,
+    LatencyTracker,
 )
 
 __version__ = "0.9.3"
@@ -18,12 +59,39 @@ __all__ = [
     "__version__",
     "StarrySky",
     "StarrySkyResult",
+    "PreviewFrame",
     "Upscaler",
     "HiResUpscaler",
     "b64_img",
+    "decode_b64_into",
+    "BufferPool",
     "ModelKeywordResult",
     "ModelKeywordInterface",
     "InstructPix2PixInterface",
     "ControlNetInterface",
     "ControlNetUnit",
+    "CancelToken",
+    "RequestCancelled",
+    "fix_seed",
+    "read_png_text",
+    "parse_generation_parameters",
+    "read_generation_parameters",
+    "scan_png_info",
+    "RateLimit",
+    "RateLimiter",
+    "TrafficArchive",
+    "RecordingAdapter",
+    "ReplayAdapter",
+    "ResultArchive",
+    "Transport",
+    "RequestsTransport",
+    "HttpxTransport",
+    "AdmissionController",
+    "merge_results",
+    "BackendScheduler",
+    "FramePipeline",
+    "Candidate",
+    "PreviewRefinePipeline",
+    "HedgedClient",
+    "LatencyTracker",
 ]
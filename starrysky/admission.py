@@ -0,0 +1,173 @@
+import math
+import threading
+import time
+from typing import List, Optional
+
+from .starrysky import StarrySky, StarrySkyResult, fix_seed
+
+# info fields that hold one entry per image and are concatenated on merge
+_PER_IMAGE_INFO = (
+    "all_prompts",
+    "all_negative_prompts",
+    "all_seeds",
+    "all_subseeds",
+    "infotexts",
+)
+
+
+class AdmissionController:
+    # Splits or defers txt2img/img2img jobs that would not fit in the backend's
+    # free VRAM (from /memory). The memory cost per pixel x batch is learned from
+    # the peak allocation of past jobs: exactly when a job raises webui's
+    # all-time peak, as an upper bound when it doesn't.
+    def __init__(
+        self,
+        api: StarrySky,
+        bytes_per_pixel: float = 4096.0,  # initial guess, refined by observed jobs
+        safety_margin: float = 0.85,  # fraction of free VRAM a job may use
+        sample_interval: float = 1.0,  # seconds a /memory sample is reused
+        max_wait: float = 60.0,  # how long to defer a job waiting for memory
+    ):
+        self.api = api
+        self.bytes_per_pixel = bytes_per_pixel
+        self._measured = False  # bytes_per_pixel is still the initial guess
+        self.safety_margin = safety_margin
+        self.sample_interval = sample_interval
+        self.max_wait = max_wait
+        self._sample = None
+        self._sampled_at = 0.0
+        self._lock = threading.Lock()
+
+    def memory(self, refresh=False) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            if refresh or self._sample is None or now - self._sampled_at > self.sample_interval:
+                self._sample = self.api.get_memory().get("cuda", {})
+                self._sampled_at = now
+            return self._sample
+
+    def free_vram(self, refresh=False) -> Optional[int]:
+        cuda = self.memory(refresh)
+        if "system" not in cuda:
+            return None  # no CUDA on the backend: nothing to manage
+        # memory torch has reserved but isn't using can be reused as well
+        reserved = cuda.get("reserved", {}).get("current", 0)
+        active = cuda.get("active", {}).get("current", 0)
+        return cuda["system"]["free"] + max(0, reserved - active)
+
+    @staticmethod
+    def pixels(kwargs) -> float:
+        pixels = kwargs.get("width", 512) * kwargs.get("height", 512)
+        if kwargs.get("enable_hr"):
+            if kwargs.get("hr_resize_x") and kwargs.get("hr_resize_y"):
+                pixels = kwargs["hr_resize_x"] * kwargs["hr_resize_y"]
+            else:
+                pixels *= kwargs.get("hr_scale", 2) ** 2
+        return pixels
+
+    def max_batch_size(self, kwargs) -> Optional[int]:
+        free = self.free_vram()
+        if free is None:
+            return None
+        cost = self.bytes_per_pixel * self.pixels(kwargs)
+        return int(free * self.safety_margin // cost)
+
+    def plan(self, kwargs) -> List[int]:
+        # batch sizes to run in place of one request of kwargs["batch_size"]
+        batch_size = kwargs.get("batch_size", 1)
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            fits = self.max_batch_size(kwargs)
+            if fits is None or fits >= batch_size:
+                return [batch_size]
+            if fits >= 1:
+                chunks = math.ceil(batch_size / fits)
+                size, extra = divmod(batch_size, chunks)
+                return [size + 1] * extra + [size] * (chunks - extra)
+            if time.monotonic() > deadline:
+                return [1] * batch_size  # smallest jobs; let the backend try
+            time.sleep(self.sample_interval)
+
+    def _learn(self, before, after, pixels):
+        if not before or not after or pixels <= 0:
+            return
+        if "active" not in before or "active" not in after:
+            return
+        start = before["active"]["current"]
+        peak = after["active"]["peak"]
+        previous_peak = before["active"]["peak"]
+        with self._lock:
+            if peak > previous_peak:
+                # the job raised webui's all-time peak: that's its usage
+                observed = (peak - start) / pixels
+                if observed > self.bytes_per_pixel or not self._measured:
+                    self.bytes_per_pixel = observed
+                else:
+                    self.bytes_per_pixel = 0.9 * self.bytes_per_pixel + 0.1 * observed
+                self._measured = True
+            else:
+                # webui never resets the peak, so it only bounds this job's
+                # usage; the true cost is at most the bound
+                bound = (previous_peak - start) / pixels
+                if bound > 0:
+                    self.bytes_per_pixel = min(self.bytes_per_pixel, bound)
+
+    def _run(self, endpoint, kwargs) -> StarrySkyResult:
+        before = self.memory(refresh=True)
+        result = getattr(self.api, endpoint)(**kwargs)
+        after = self.memory(refresh=True)
+        self._learn(before, after, self.pixels(kwargs) * kwargs.get("batch_size", 1))
+        return result
+
+    def _call(self, endpoint, kwargs) -> StarrySkyResult:
+        sizes = self.plan(kwargs)
+        n_iter = kwargs.get("n_iter", 1)
+        if len(sizes) == 1:
+            return self._run(endpoint, kwargs)
+
+        # seeds as webui assigns them to the full batch: seed + image index
+        # (unless variation seeds are used), subseed + image index
+        seed = fix_seed(kwargs.get("seed", -1))
+        subseed = fix_seed(kwargs.get("subseed", -1))
+        seed_step = 1 if not kwargs.get("subseed_strength") else 0
+        batch_size = sum(sizes)
+
+        results = []
+        for iteration in range(n_iter):
+            offset = iteration * batch_size
+            for size in sizes:
+                sub = dict(kwargs)
+                sub.update(
+                    batch_size=size,
+                    n_iter=1,
+                    seed=seed + offset * seed_step,
+                    subseed=subseed + offset,
+                )
+                results.append(self._run(endpoint, sub))
+                offset += size
+
+        result = merge_results(results)
+        if isinstance(result.parameters, dict):
+            result.parameters = dict(
+                result.parameters, batch_size=batch_size, n_iter=n_iter, seed=seed
+            )
+        return result
+
+    def txt2img(self, **kwargs) -> StarrySkyResult:
+        return self._call("txt2img", kwargs)
+
+    def img2img(self, **kwargs) -> StarrySkyResult:
+        return self._call("img2img", kwargs)
+
+
+def merge_results(results: List[StarrySkyResult]) -> StarrySkyResult:
+    images = []
+    for r in results:
+        images.extend(r.images)
+    info = results[0].info
+    if isinstance(info, dict):
+        info = dict(info)
+        for key in _PER_IMAGE_INFO:
+            if key in info:
+                info[key] = [x for r in results for x in r.info.get(key, [])]
+    return StarrySkyResult(images, results[0].parameters, info)
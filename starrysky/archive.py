@@ -0,0 +1,207 @@
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+from typing import Iterator
+
+from PIL import Image
+
+from .starrysky import StarrySkyResult, _png_bytes, _png_from_array
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialized within a process
+    fcntl = None
+
+# Append-only archive of StarrySkyResults:
+#
+#   <path>      records: header, image lengths, JSON metadata, image bytes
+#   <path>.idx  one (offset, length) entry per record
+#
+# A record is only visible once its index entry is written, so a crash while
+# appending never exposes a partial record. Several threads and processes may
+# append to the same archive; readers memory-map both files.
+#
+#   with ResultArchive("run.ssa", "a") as archive:
+#       archive.append(api.txt2img(prompt="cute squirrel", raw_images=True))
+#
+#   archive = ResultArchive("run.ssa")
+#   archive.metadata(123)["info"]["seed"], archive.image(123, 0)
+
+MAGIC = b"SSR1"
+_HEADER = struct.Struct("<4sII")  # magic, metadata length, image count
+_LENGTH = struct.Struct("<Q")
+_INDEX_ENTRY = struct.Struct("<QQ")  # record offset, record length
+
+
+def _encode_image(image) -> bytes:
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)  # raw_images=True: stored as returned by webui
+    if not isinstance(image, Image.Image):
+        return _png_from_array(image)
+    return _png_bytes(image)
+
+
+def _write_at(fd, data, offset):
+    os.lseek(fd, offset, os.SEEK_SET)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _encode_record(result: StarrySkyResult) -> bytes:
+    images = [_encode_image(image) for image in result.images]
+    metadata = json.dumps(
+        {"parameters": result.parameters, "info": result.info},
+        separators=(",", ":"),
+        default=str,
+    ).encode("utf-8")
+    parts = [_HEADER.pack(MAGIC, len(metadata), len(images))]
+    parts.extend(_LENGTH.pack(len(data)) for data in images)
+    parts.append(metadata)
+    parts.extend(images)
+    return b"".join(parts)
+
+
+class ResultArchive:
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "a"):
+            raise ValueError("mode must be 'r' or 'a'")
+        self.path = path
+        self.mode = mode
+        flags = os.O_RDONLY if mode == "r" else os.O_RDWR | os.O_CREAT
+        flags |= getattr(os, "O_BINARY", 0)
+        self._data_fd = os.open(path, flags, 0o644)
+        self._index_fd = os.open(path + ".idx", flags, 0o644)
+        self._data = None
+        self._index = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    # writing
+
+    def append(self, result: StarrySkyResult) -> int:
+        # -> index of the new record
+        if self.mode != "a":
+            raise RuntimeError("archive is not open for appending")
+        record = _encode_record(result)  # encoded outside the lock
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._data_fd, fcntl.LOCK_EX)
+            try:
+                # drop a torn index entry left by a crashed writer
+                index_size = os.fstat(self._index_fd).st_size
+                index_size -= index_size % _INDEX_ENTRY.size
+                os.ftruncate(self._index_fd, index_size)
+
+                offset = os.fstat(self._data_fd).st_size
+                _write_at(self._data_fd, record, offset)
+                _write_at(
+                    self._index_fd, _INDEX_ENTRY.pack(offset, len(record)), index_size
+                )
+                return index_size // _INDEX_ENTRY.size
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._data_fd, fcntl.LOCK_UN)
+
+    def flush(self):
+        os.fsync(self._data_fd)
+        os.fsync(self._index_fd)
+
+    # reading
+
+    def _remap(self):
+        # picks up records appended since the archive was mapped
+        index_size = os.fstat(self._index_fd).st_size
+        count = index_size // _INDEX_ENTRY.size
+        if count == self._count and self._index is not None:
+            return
+        # earlier maps stay valid for slices handed out before; they're
+        # released when no longer referenced
+        self._count = count
+        if count == 0:
+            return
+        self._index = mmap.mmap(
+            self._index_fd, count * _INDEX_ENTRY.size, access=mmap.ACCESS_READ
+        )
+        self._data = mmap.mmap(self._data_fd, 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        with self._lock:
+            self._remap()
+            return self._count
+
+    def _record(self, i):
+        with self._lock:
+            if not -self._count <= i < self._count:
+                self._remap()
+            if i < 0:
+                i += self._count
+            if not 0 <= i < self._count:
+                raise IndexError("archive record index out of range")
+            offset, length = _INDEX_ENTRY.unpack_from(self._index, i * _INDEX_ENTRY.size)
+            data = self._data
+        magic, metadata_length, image_count = _HEADER.unpack_from(data, offset)
+        if magic != MAGIC:
+            raise ValueError(f"corrupt archive record {i} at offset {offset}")
+        pos = offset + _HEADER.size
+        lengths = [
+            _LENGTH.unpack_from(data, pos + n * _LENGTH.size)[0]
+            for n in range(image_count)
+        ]
+        pos += image_count * _LENGTH.size
+        metadata = (pos, metadata_length)
+        pos += metadata_length
+        images = []
+        for image_length in lengths:
+            images.append((pos, image_length))
+            pos += image_length
+        return data, metadata, images
+
+    def metadata(self, i) -> dict:
+        # {"parameters": ..., "info": ...} without touching the images
+        data, (pos, length), _ = self._record(i)
+        return json.loads(data[pos : pos + length])
+
+    def image_count(self, i) -> int:
+        return len(self._record(i)[2])
+
+    def image_bytes(self, i, j=0) -> memoryview:
+        # zero-copy view of the encoded image
+        data, _, images = self._record(i)
+        pos, length = images[j]
+        return memoryview(data)[pos : pos + length]
+
+    def image(self, i, j=0) -> Image.Image:
+        return Image.open(io.BytesIO(self.image_bytes(i, j)))
+
+    def __getitem__(self, i) -> StarrySkyResult:
+        data, (pos, length), images = self._record(i)
+        metadata = json.loads(data[pos : pos + length])
+        return StarrySkyResult(
+            images=[Image.open(io.BytesIO(data[p : p + n])) for p, n in images],
+            parameters=metadata["parameters"],
+            info=metadata["info"],
+        )
+
+    def __iter__(self) -> Iterator[StarrySkyResult]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        with self._lock:
+            # maps with slices still in use are closed when those are released
+            self._index = self._data = None
+            self._count = 0
+            for fd in (self._data_fd, self._index_fd):
+                if fd >= 0:
+                    os.close(fd)
+            self._data_fd = self._index_fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
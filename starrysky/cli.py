@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .starrysky import StarrySky
+from .pipeline import BackendScheduler
+
+# starrysky jobs.jsonl --baseurl http://gpu1:7860/sdapi/v1 --baseurl http://gpu2:7860/sdapi/v1 -o out
+#
+# One job per manifest line:
+#   {"id": "cat-1", "type": "txt2img", "params": {"prompt": "cute cat", "seed": 1}}
+#   {"id": "dog-up", "type": "extra-single-image", "params": {"image": "photos/dog.png", "upscaling_resize": 2}}
+# type defaults to txt2img; without "params" the other keys are the parameters.
+# Image parameters (images, mask_image, image) are file paths.
+# Jobs must be independent: they run concurrently and finish in any order, so a
+# job can't read another job's output (use a second manifest for that).
+
+ENDPOINTS = {
+    "txt2img": "txt2img",
+    "img2img": "img2img",
+    "extra-single-image": "extra_single_image",
+    "extra-batch-images": "extra_batch_images",
+}
+
+
+def read_manifest(path):
+    # -> iterator of (job id, endpoint, params)
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{lineno}: invalid JSON: {e}") from None
+            job_id = str(job.pop("id", f"line-{lineno}"))
+            job_type = job.pop("type", "txt2img")
+            if job_type not in ENDPOINTS:
+                raise ValueError(f"{path}:{lineno}: unknown job type {job_type!r}")
+            params = job.pop("params", job)
+            yield job_id, ENDPOINTS[job_type], params
+
+
+class Checkpoint:
+    # completed job ids, one per line; appended as jobs finish
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        torn = False
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        self.done.add(line[:-1])
+                    else:
+                        torn = True  # id cut off by a crash: the job is rerun
+        self._file = open(path, "a", encoding="utf-8")
+        if torn:
+            self._file.write("\n")
+        self._lock = threading.Lock()
+
+    def add(self, job_id):
+        with self._lock:
+            self._file.write(job_id + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.done.add(job_id)
+
+    def close(self):
+        self._file.close()
+
+
+def _safe_name(job_id):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in job_id)
+
+
+def _write_file(path, data):
+    # written under a temporary name so a crash never leaves a partial output
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def save_result(result, job_id, output_dir, archive=None):
+    if archive is not None:
+        archive.append(result)
+        return
+    name = os.path.join(output_dir, _safe_name(job_id))
+    for n, image in enumerate(result.images):
+        _write_file(f"{name}-{n}.png", image)
+    metadata = {"parameters": result.parameters, "info": result.info}
+    _write_file(name + ".json", json.dumps(metadata, default=str).encode("utf-8"))
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def print_summary(stats, elapsed, file=sys.stdout):
+    latencies = sorted(stats["latencies"])
+    done = len(latencies)
+    print(
+        f"{done} jobs done, {stats['skipped']} skipped, {stats['failed']} failed "
+        f"in {elapsed:.1f}s",
+        file=file,
+    )
+    if done and elapsed > 0:
+        print(
+            f"throughput: {done / elapsed:.2f} jobs/s, "
+            f"{stats['images'] / elapsed:.2f} images/s",
+            file=file,
+        )
+        print(
+            "latency: "
+            f"p50 {_percentile(latencies, 0.5):.2f}s, "
+            f"p90 {_percentile(latencies, 0.9):.2f}s, "
+            f"p99 {_percentile(latencies, 0.99):.2f}s, "
+            f"max {latencies[-1]:.2f}s",
+            file=file,
+        )
+
+
+def run(
+    manifest,
+    apis,
+    output_dir,
+    checkpoint_path=None,
+    concurrency=1,
+    retries=2,
+    timeout=None,
+    archive=None,
+    quiet=False,
+):
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = Checkpoint(checkpoint_path or os.path.join(output_dir, "done.txt"))
+    scheduler = BackendScheduler(apis, max_in_flight=concurrency)
+    stats = {"latencies": [], "images": 0, "skipped": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def run_job(job_id, endpoint, params):
+        for attempt in range(retries + 1):
+            try:
+                with scheduler.backend() as api:
+                    start = time.monotonic()
+                    result = getattr(api, endpoint)(
+                        raw_images=True, timeout=timeout, **params
+                    )
+                    latency = time.monotonic() - start
+                break
+            except Exception as e:
+                if attempt == retries:
+                    with lock:
+                        stats["failed"] += 1
+                    print(f"{job_id}: failed: {e}", file=sys.stderr)
+                    return
+                time.sleep(2.0 ** attempt)
+        save_result(result, job_id, output_dir, archive)
+        checkpoint.add(job_id)
+        with lock:
+            stats["latencies"].append(latency)
+            stats["images"] += len(result.images)
+        if not quiet:
+            print(f"{job_id}: {len(result.images)} images in {latency:.2f}s")
+
+    start = time.monotonic()
+    pending = set()
+    # bounded window so huge manifests aren't loaded into memory
+    window = 2 * scheduler.capacity
+    try:
+        with ThreadPoolExecutor(max_workers=scheduler.capacity) as executor:
+            for job_id, endpoint, params in read_manifest(manifest):
+                if job_id in checkpoint.done:
+                    stats["skipped"] += 1
+                    continue
+                if len(pending) >= window:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(run_job, job_id, endpoint, params))
+            for future in pending:
+                future.result()
+    finally:
+        checkpoint.close()
+    stats["elapsed"] = time.monotonic() - start
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="starrysky",
+        description="Run txt2img/img2img/extras jobs from a JSONL manifest.",
+    )
+    parser.add_argument("manifest", help="JSONL file, one job per line")
+    parser.add_argument(
+        "--baseurl",
+        action="append",
+        help="webui API base URL, e.g. http://127.0.0.1:7860/sdapi/v1 (repeatable)",
+    )
+    parser.add_argument(
+        "--token", default=os.environ.get("STARRYSKY_TOKEN"),
+        help="API token (default: $STARRYSKY_TOKEN)",
+    )
+    parser.add_argument("-o", "--output", default="output", help="output directory")
+    parser.add_argument(
+        "--checkpoint", help="completed job ids (default: <output>/done.txt)"
+    )
+    parser.add_argument(
+        "-j", "--concurrency", type=int, default=1,
+        help="jobs in flight per base URL (default: 1)",
+    )
+    parser.add_argument(
+        "--retries", type=int, default=2, help="retries per failed job (default: 2)"
+    )
+    parser.add_argument("--timeout", type=float, help="seconds per request")
+    parser.add_argument(
+        "--archive", help="append results to a ResultArchive instead of PNG/JSON files"
+    )
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the summary")
+    args = parser.parse_args(argv)
+
+    if not args.token:
+        parser.error("an API token is required (--token or $STARRYSKY_TOKEN)")
+    apis = [
+        StarrySky(baseurl=url, token=args.token, pool_maxsize=max(10, args.concurrency))
+        for url in args.baseurl or ["http://127.0.0.1:7860/sdapi/v1"]
+    ]
+    archive = None
+    if args.archive:
+        from .archive import ResultArchive
+
+        archive = ResultArchive(args.archive, "a")
+    try:
+        stats = run(
+            args.manifest,
+            apis,
+            args.output,
+            checkpoint_path=args.checkpoint,
+            concurrency=args.concurrency,
+            retries=args.retries,
+            timeout=args.timeout,
+            archive=archive,
+            quiet=args.quiet,
+        )
+    finally:
+        if archive is not None:
+            archive.close()
+    print_summary(stats, stats["elapsed"])
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
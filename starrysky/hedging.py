@@ -0,0 +1,174 @@
+import collections
+import itertools
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+from .starrysky import (
+    StarrySky,
+    StarrySkyResult,
+    CancelToken,
+    RequestCancelled,
+    fix_seed,
+)
+
+
+class LatencyTracker:
+    # rolling window of latencies per endpoint
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, endpoint: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+@dataclass
+class HedgeStats:
+    requests: int = 0
+    hedged: int = 0  # second request sent
+    hedge_wins: int = 0  # the second request finished first
+    budget_exhausted: int = 0  # would have hedged, but over budget
+    failed_over: int = 0  # first request failed, the hedge's result was used
+
+
+class HedgedClient:
+    # Sends txt2img/img2img to one backend and, if it hasn't finished within the
+    # endpoint's latency percentile, the same payload (with a fixed seed) to a
+    # second backend. The first result wins; the other job is interrupted.
+    def __init__(
+        self,
+        apis,
+        percentile: float = 0.95,
+        budget: float = 0.1,  # max fraction of requests that may be hedged
+        initial_delay: float = 30.0,  # hedge delay until enough samples exist
+        min_delay: float = 0.5,
+        window: int = 200,
+        min_samples: int = 20,
+        max_workers: int = 32,
+    ):
+        if isinstance(apis, StarrySky):
+            apis = [apis]
+        self.apis = list(apis)
+        if len(self.apis) == 0:
+            raise ValueError("at least one StarrySky backend is required")
+        self.percentile = percentile
+        self.budget = budget
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.latencies = LatencyTracker(window, min_samples)
+        self._stats = HedgeStats()
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return asdict(self._stats)
+
+    def hedge_delay(self, endpoint: str) -> float:
+        delay = self.latencies.percentile(endpoint, self.percentile)
+        if delay is None:
+            delay = self.initial_delay
+        return max(self.min_delay, delay)
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self._stats.hedged + 1 > self.budget * self._stats.requests:
+                self._stats.budget_exhausted += 1
+                return False
+            self._stats.hedged += 1
+            return True
+
+    def _attempt(self, api, endpoint, kwargs, token):
+        return getattr(api, endpoint)(cancel_token=token, **kwargs)
+
+    def _call(self, endpoint, kwargs) -> StarrySkyResult:
+        caller_token = kwargs.pop("cancel_token", None)
+        # both backends must render the same image
+        kwargs["seed"] = fix_seed(kwargs.get("seed", -1))
+        kwargs["subseed"] = fix_seed(kwargs.get("subseed", -1))
+        with self._lock:
+            self._stats.requests += 1
+
+        # latency as the caller sees it (including the hedge delay), also
+        # when every attempt fails, so hedging doesn't lower its own threshold
+        start = time.monotonic()
+        n = next(self._next)
+        primary = self.apis[n % len(self.apis)]
+        attempts = {}
+
+        def cancel_all():
+            for token in list(attempts.values()):
+                token.cancel()
+
+        if caller_token is not None:
+            caller_token.add_callback(cancel_all)
+        try:
+            token = CancelToken()
+            future = self._executor.submit(self._attempt, primary, endpoint, kwargs, token)
+            attempts[future] = token
+            if caller_token is not None and caller_token.cancelled:
+                token.cancel()
+
+            done, _ = wait([future], timeout=self.hedge_delay(endpoint))
+            cancelled = caller_token is not None and caller_token.cancelled
+            if not done and not cancelled and len(self.apis) > 1 and self._take_budget():
+                secondary = self.apis[(n + 1) % len(self.apis)]
+                token = CancelToken()
+                hedge = self._executor.submit(self._attempt, secondary, endpoint, kwargs, token)
+                attempts[hedge] = token
+
+            pending = set(attempts)
+            error = None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for finished in done:
+                    try:
+                        result = finished.result()
+                    except RequestCancelled:
+                        continue
+                    except Exception as e:
+                        error = e
+                        continue
+                    for other in pending:
+                        attempts[other].cancel()
+                    self.latencies.record(endpoint, time.monotonic() - start)
+                    with self._lock:
+                        if finished is not future:
+                            self._stats.hedge_wins += 1
+                            if future.done() and future.exception() is not None:
+                                self._stats.failed_over += 1
+                    return result
+            if error is not None:
+                self.latencies.record(endpoint, time.monotonic() - start)
+                raise error
+            raise RequestCancelled("request cancelled")
+        finally:
+            if caller_token is not None:
+                caller_token.remove_callback(cancel_all)
+
+    def txt2img(self, **kwargs) -> StarrySkyResult:
+        return self._call("txt2img", kwargs)
+
+    def img2img(self, **kwargs) -> StarrySkyResult:
+        return self._call("img2img", kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,285 @@
+import collections
+import copy
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .starrysky import StarrySky, StarrySkyResult, ControlNetUnit, b64_img, fix_seed
+
+
+class BackendScheduler:
+    # hands out the least busy backend, at most max_in_flight jobs per backend
+    def __init__(self, apis, max_in_flight: int = 2):
+        apis = self._backends(apis)
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be >= 1")
+        self.apis = apis
+        self.max_in_flight = max_in_flight
+        self._in_flight = [0] * len(apis)
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _backends(apis) -> List[StarrySky]:
+        if isinstance(apis, StarrySky):
+            apis = [apis]
+        apis = list(apis)
+        if len(apis) == 0:
+            raise ValueError("at least one StarrySky backend is required")
+        return apis
+
+    @classmethod
+    def for_total(cls, apis, in_flight: Optional[int] = None):
+        # in_flight jobs spread over the backends (default: 2 per backend)
+        apis = cls._backends(apis)
+        if in_flight is None:
+            in_flight = 2 * len(apis)
+        if in_flight < 1:
+            raise ValueError("in_flight must be >= 1")
+        return cls(apis, max_in_flight=-(-in_flight // len(apis)))
+
+    @property
+    def capacity(self):
+        return len(self.apis) * self.max_in_flight
+
+    def acquire(self) -> StarrySky:
+        with self._cond:
+            while True:
+                index = min(range(len(self.apis)), key=lambda i: self._in_flight[i])
+                if self._in_flight[index] < self.max_in_flight:
+                    self._in_flight[index] += 1
+                    return self.apis[index]
+                self._cond.wait()
+
+    def release(self, api: StarrySky):
+        with self._cond:
+            index = next(i for i, x in enumerate(self.apis) if x is api)
+            self._in_flight[index] -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def backend(self):
+        api = self.acquire()
+        try:
+            yield api
+        finally:
+            self.release(api)
+
+
+_END = object()
+
+
+class FramePipeline:
+    def __init__(
+        self,
+        apis,
+        in_flight: Optional[int] = None,  # default: 2 per backend
+        prefetch: int = 4,  # encoded frames waiting to be sent
+        reorder_window: Optional[int] = None,  # finished results held for ordering
+        seed: Union[int, Callable[[int], int]] = -1,
+        controlnet_units: List[ControlNetUnit] = None,
+        # (frame index, source frame, encoded frame) -> extra units
+        controlnet_fn: Callable[[int, object, str], List[ControlNetUnit]] = None,
+        **img2img_kwargs,
+    ):
+        self.scheduler = BackendScheduler.for_total(apis, in_flight)
+        self.in_flight = in_flight or self.scheduler.capacity
+        self.prefetch = max(1, prefetch)
+        self.reorder_window = max(self.in_flight, reorder_window or 2 * self.in_flight)
+        self.seed = seed
+        self.controlnet_units = controlnet_units or []
+        self.controlnet_fn = controlnet_fn
+        self.img2img_kwargs = img2img_kwargs
+
+    def _seed_for(self, index):
+        if callable(self.seed):
+            return self.seed(index)
+        return self.seed
+
+    def _units_for(self, index, frame, encoded):
+        # units without input_image use the frame itself (already encoded once)
+        units = []
+        for unit in self.controlnet_units:
+            if unit.input_image is None:
+                unit = copy.copy(unit)
+                unit.input_image = encoded
+            units.append(unit)
+        if self.controlnet_fn is not None:
+            units.extend(self.controlnet_fn(index, frame, encoded))
+        return units
+
+    def _process(self, index, item) -> StarrySkyResult:
+        frame, encoded = item
+        kwargs = dict(self.img2img_kwargs)
+        kwargs["seed"] = self._seed_for(index)
+        units = self._units_for(index, frame, encoded)
+        with self.scheduler.backend() as api:
+            return api.img2img(images=[encoded], controlnet_units=units, **kwargs)
+
+    @staticmethod
+    def _put(encoded_queue, item, stop) -> bool:
+        # gives up once the consumer has stopped, so a full queue can't block
+        while not stop.is_set():
+            try:
+                encoded_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, frames, encoded_queue, stop):
+        try:
+            for frame in frames:
+                if not self._put(encoded_queue, (frame, b64_img(frame)), stop):
+                    return
+            self._put(encoded_queue, _END, stop)
+        except BaseException as e:
+            self._put(encoded_queue, e, stop)
+
+    def run(self, frames: Iterable) -> Iterator[StarrySkyResult]:
+        encoded_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(
+            target=self._produce, args=(iter(frames), encoded_queue, stop), daemon=True
+        )
+        producer.start()
+
+        executor = ThreadPoolExecutor(max_workers=self.in_flight)
+        pending = collections.deque()
+        index = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.reorder_window:
+                    item = encoded_queue.get()
+                    if item is _END:
+                        exhausted = True
+                    elif isinstance(item, BaseException):
+                        raise item
+                    else:
+                        pending.append(executor.submit(self._process, index, item))
+                        index += 1
+                if not pending:
+                    break
+                yield pending.popleft().result()
+        finally:
+            stop.set()
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+@dataclass
+class Candidate:
+    index: int
+    seed: int
+    result: StarrySkyResult  # low-res preview
+
+    @property
+    def image(self):
+        return self.result.image
+
+
+# txt2img-only options dropped when refining with img2img
+_TXT2IMG_ONLY = (
+    "enable_hr",
+    "firstphase_width",
+    "firstphase_height",
+    "hr_scale",
+    "hr_upscaler",
+    "hr_second_pass_steps",
+    "hr_resize_x",
+    "hr_resize_y",
+)
+
+
+class PreviewRefinePipeline:
+    # Stage one renders cheap txt2img previews concurrently and streams them to
+    # a selector; stage two refines only the selected candidates with the same
+    # seed, either with hires fix (same first pass as the preview) or img2img.
+    def __init__(self, apis, in_flight: Optional[int] = None):
+        self.scheduler = BackendScheduler.for_total(apis, in_flight)
+        self.in_flight = in_flight or self.scheduler.capacity
+
+    def _txt2img(self, kwargs):
+        with self.scheduler.backend() as api:
+            return api.txt2img(**kwargs)
+
+    def _img2img(self, kwargs):
+        with self.scheduler.backend() as api:
+            return api.img2img(**kwargs)
+
+    def _refine(self, candidate, preview_kwargs, refine, refine_kwargs):
+        if refine == "hires":
+            kwargs = dict(preview_kwargs, enable_hr=True)
+            kwargs.update(refine_kwargs)
+            return self._txt2img(kwargs)
+
+        kwargs = {k: v for k, v in preview_kwargs.items() if k not in _TXT2IMG_ONLY}
+        scale = refine_kwargs.pop("scale", 2)
+        kwargs["width"] = int(preview_kwargs.get("width", 512) * scale)
+        kwargs["height"] = int(preview_kwargs.get("height", 512) * scale)
+        kwargs.pop("steps", None)
+        kwargs.update(refine_kwargs)
+        kwargs["images"] = [candidate.image]
+        return self._img2img(kwargs)
+
+    def run(
+        self,
+        count: int,
+        selector: Callable[[Candidate], bool],
+        seed: int = -1,  # candidate i uses seed + i (random seeds for -1)
+        preview_steps: int = 10,
+        refine: str = "hires",  # "hires" or "img2img"
+        refine_kwargs: dict = None,  # e.g. hr_scale, hr_second_pass_steps, denoising_strength
+        **txt2img_kwargs,
+    ) -> Iterator[Tuple[Candidate, Optional[StarrySkyResult]]]:
+        # yields (candidate, refined result) for selected candidates and
+        # (candidate, None) for rejected ones, in completion order
+        if refine not in ("hires", "img2img"):
+            raise ValueError("refine must be 'hires' or 'img2img'")
+        refine_kwargs = dict(refine_kwargs or {})
+
+        def preview_kwargs(index):
+            kwargs = dict(txt2img_kwargs)
+            kwargs["steps"] = preview_steps
+            kwargs["batch_size"] = 1
+            kwargs["n_iter"] = 1
+            kwargs["seed"] = fix_seed(seed) if seed == -1 else seed + index
+            return kwargs
+
+        executor = ThreadPoolExecutor(max_workers=self.scheduler.capacity)
+        jobs = {}
+        next_index = 0
+        try:
+            while next_index < count or jobs:
+                # keep only in_flight previews queued so selected refinements
+                # don't wait behind the whole preview backlog
+                previews = sum(1 for job in jobs.values() if job[0] == "preview")
+                while next_index < count and previews < self.in_flight:
+                    kwargs = preview_kwargs(next_index)
+                    future = executor.submit(self._txt2img, kwargs)
+                    jobs[future] = ("preview", next_index, kwargs)
+                    next_index += 1
+                    previews += 1
+
+                done, _ = wait(list(jobs), return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, payload, kwargs = jobs.pop(future)
+                    if kind == "refine":
+                        yield payload, future.result()
+                        continue
+                    candidate = Candidate(payload, kwargs["seed"], future.result())
+                    if selector(candidate):
+                        refined = executor.submit(
+                            self._refine, candidate, kwargs, refine, dict(refine_kwargs)
+                        )
+                        jobs[refined] = ("refine", candidate, kwargs)
+                    else:
+                        yield candidate, None
+        finally:
+            for future in jobs:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,176 @@
+import json
+import mmap
+import os
+import re
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
+
+# Reads generation info from PNG text chunks locally, without decoding pixels
+# or uploading the image to /png-info.
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# same as modules/generation_parameters_copypaste.py in webui
+re_param = re.compile(r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
+re_imagesize = re.compile(r"^(\d+)x(\d+)$")
+re_number = re.compile(r"^-?\d+(\.\d+)?$")
+
+
+def _parse_text_chunks(data) -> Dict[str, str]:
+    if bytes(data[:8]) != PNG_SIGNATURE:
+        raise ValueError("not a PNG file")
+
+    texts = {}
+    pos = 8
+    end = len(data)
+    while pos + 8 <= end:
+        length, tag = struct.unpack(">I4s", data[pos : pos + 8])
+        body = pos + 8
+        if tag in (b"tEXt", b"zTXt", b"iTXt"):
+            chunk = bytes(data[body : body + length])
+            key, _, rest = chunk.partition(b"\0")
+            key = key.decode("latin-1")
+            if tag == b"tEXt":
+                texts[key] = rest.decode("latin-1")
+            elif tag == b"zTXt":
+                texts[key] = zlib.decompress(rest[1:]).decode("latin-1")
+            else:
+                compressed = rest[0]
+                _, _, rest = rest[2:].partition(b"\0")  # language tag
+                _, _, text = rest.partition(b"\0")  # translated keyword
+                if compressed:
+                    text = zlib.decompress(text)
+                texts[key] = text.decode("utf-8")
+        elif tag == b"IEND":
+            break
+        pos = body + length + 4  # skip data (pixels are never read) and CRC
+    return texts
+
+
+def read_png_text(source) -> Dict[str, str]:
+    # source: PNG bytes, a file path (memory-mapped) or a PIL image
+    if hasattr(source, "info") and hasattr(source, "mode"):
+        return {k: v for k, v in source.info.items() if isinstance(v, str)}
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return _parse_text_chunks(source)
+    with open(source, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"empty file: {source}")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _parse_text_chunks(data)
+
+
+def _unquote(text):
+    if len(text) == 0 or text[0] != '"' or text[-1] != '"':
+        return text
+    try:
+        return json.loads(text)
+    except Exception:
+        return text
+
+
+def _convert(value):
+    if re_number.match(value):
+        return float(value) if "." in value else int(value)
+    return value
+
+
+def parse_generation_parameters(text: str) -> dict:
+    # A1111 "parameters" text -> {"prompt", "negative_prompt", "Steps", "Seed", ...}
+    res = {}
+    prompt = ""
+    negative_prompt = ""
+    done_with_prompt = False
+
+    *lines, lastline = text.strip().split("\n")
+    if len(re_param.findall(lastline)) < 3:
+        lines.append(lastline)
+        lastline = ""
+
+    for line in lines:
+        line = line.strip()
+        if line.startswith("Negative prompt:"):
+            done_with_prompt = True
+            line = line[16:].strip()
+        if done_with_prompt:
+            negative_prompt += ("" if negative_prompt == "" else "\n") + line
+        else:
+            prompt += ("" if prompt == "" else "\n") + line
+
+    res["prompt"] = prompt
+    res["negative_prompt"] = negative_prompt
+
+    for k, v in re_param.findall(lastline):
+        v = _unquote(v.strip())
+        m = re_imagesize.match(v) if isinstance(v, str) else None
+        if m is not None:
+            res[f"{k}-1"] = int(m.group(1))
+            res[f"{k}-2"] = int(m.group(2))
+        res[k] = _convert(v) if isinstance(v, str) else v
+
+    return res
+
+
+def read_generation_parameters(source) -> Optional[dict]:
+    text = read_png_text(source).get("parameters")
+    if text is None:
+        return None
+    return parse_generation_parameters(text)
+
+
+def _scan_chunk(paths):
+    results = []
+    for path in paths:
+        try:
+            results.append((path, read_generation_parameters(path)))
+        except (OSError, ValueError, struct.error, zlib.error):
+            results.append((path, None))
+    return results
+
+
+def _iter_png_paths(paths, recursive):
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                for root, _, files in os.walk(path):
+                    for name in sorted(files):
+                        if name.lower().endswith(".png"):
+                            yield os.path.join(root, name)
+            else:
+                for name in sorted(os.listdir(path)):
+                    if name.lower().endswith(".png"):
+                        yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def scan_png_info(
+    paths: Union[str, os.PathLike, Iterable],
+    max_workers: Optional[int] = None,
+    use_processes: bool = False,
+    recursive: bool = True,
+    chunksize: int = 64,
+) -> Iterator[Tuple[str, Optional[dict]]]:
+    # yields (path, parameters) for files/directories in input order; parameters
+    # is None when a file has no generation info or can't be read
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=max_workers) as executor:
+        window = 4 * (max_workers or os.cpu_count() or 1)
+        pending = []
+        chunk = []
+
+        for path in _iter_png_paths(paths, recursive):
+            chunk.append(path)
+            if len(chunk) == chunksize:
+                pending.append(executor.submit(_scan_chunk, chunk))
+                chunk = []
+                if len(pending) >= window:
+                    yield from pending.pop(0).result()
+        if chunk:
+            pending.append(executor.submit(_scan_chunk, chunk))
+        for future in pending:
+            yield from future.result()
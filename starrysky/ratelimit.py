@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import urlparse
+
+
+# endpoints that run a job on the backend; only these count towards
+# max_concurrent, so progress polls, interrupts etc. are never stuck behind a
+# running job (they still use the requests_per_second bucket). Transports tell
+# the limiter explicitly; the paths are for callers that don't.
+GENERATION_ENDPOINTS = (
+    "/txt2img",
+    "/img2img",
+    "/extra-single-image",
+    "/extra-batch-images",
+)
+
+
+@dataclass
+class RateLimit:
+    requests_per_second: Optional[float] = None
+    burst: int = 1  # requests that may be sent back to back
+    max_concurrent: Optional[int] = None  # generation requests in progress at once
+
+
+class _Bucket:
+    # token bucket plus a concurrency gate, shared by threads and event loops
+    def __init__(self, limit: RateLimit):
+        self.rate = limit.requests_per_second
+        self.capacity = max(1, limit.burst)
+        self.max_concurrent = limit.max_concurrent
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.active = 0
+        self.cond = threading.Condition()
+
+    def reserve(self) -> float:
+        # takes a token now and returns how long to wait before using it, so
+        # bursts are spread out instead of rejected
+        with self.cond:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.rate:
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def try_enter(self) -> bool:
+        with self.cond:
+            if self.max_concurrent is not None and self.active >= self.max_concurrent:
+                return False
+            self.active += 1
+            return True
+
+    def enter(self):
+        with self.cond:
+            while self.max_concurrent is not None and self.active >= self.max_concurrent:
+                self.cond.wait()
+            self.active += 1
+
+    def leave(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def pause(self, seconds: float):
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def parse_retry_after(value) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    # Client-side limits per base URL (host) and per API token. One instance can
+    # be shared by several StarrySky clients, threads and asyncio tasks.
+    def __init__(
+        self,
+        per_baseurl: RateLimit = None,
+        per_token: RateLimit = None,
+        max_retries: int = 3,  # retries of 429/503 responses
+        max_retry_after: float = 300.0,
+    ):
+        self.per_baseurl = per_baseurl
+        self.per_token = per_token
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, limit):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket(limit)
+            return bucket
+
+    def buckets(self, url, authorization=None):
+        buckets = []
+        if self.per_baseurl is not None:
+            host = urlparse(url).netloc
+            buckets.append(self._bucket(("baseurl", host), self.per_baseurl))
+        if self.per_token is not None and authorization:
+            digest = hashlib.sha256(authorization.encode()).hexdigest()
+            buckets.append(self._bucket(("token", digest), self.per_token))
+        return buckets
+
+    @staticmethod
+    def gated(url) -> bool:
+        # whether the request counts towards max_concurrent
+        return urlparse(url).path.rstrip("/").endswith(GENERATION_ENDPOINTS)
+
+    # both acquires give back the slots they took if interrupted or cancelled
+    # at any point, including while waiting out the requests/sec delay
+
+    def acquire(self, url, authorization=None, gated=True):
+        buckets = self.buckets(url, authorization)
+        entered = []
+        try:
+            for bucket in buckets if gated else ():
+                bucket.enter()
+                entered.append(bucket)
+            delay = max([b.reserve() for b in buckets], default=0.0)
+            if delay > 0:
+                time.sleep(delay)
+        except BaseException:
+            self.release(entered)
+            raise
+        return buckets
+
+    async def acquire_async(self, url, authorization=None, gated=True):
+        buckets = self.buckets(url, authorization)
+        entered = []
+        try:
+            for bucket in buckets if gated else ():
+                backoff = 0.005
+                while not bucket.try_enter():
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 0.1)
+                entered.append(bucket)
+            delay = max([b.reserve() for b in buckets], default=0.0)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            self.release(entered)
+            raise
+        return buckets
+
+    def release(self, buckets, gated=True):
+        if gated:
+            for bucket in buckets:
+                bucket.leave()
+
+    def backoff(self, buckets, status, headers, attempt) -> Optional[float]:
+        # -> seconds the buckets are paused for when the response should be
+        # retried, None otherwise
+        if status not in (429, 503) or attempt >= self.max_retries:
+            return None
+        delay = parse_retry_after(headers.get("Retry-After"))
+        if delay is None:
+            if status == 503:
+                return None
+            delay = 2.0 ** attempt
+        delay = min(delay, self.max_retry_after)
+        for bucket in buckets:
+            bucket.pause(delay)
+        return delay
+
+    def call(self, url, authorization, send, gated=None):
+        # send() -> response with status_code, headers and close(); sent again
+        # after a 429/503 backoff. gated=None: decided from the url
+        if gated is None:
+            gated = self.gated(url)
+        attempt = 0
+        while True:
+            buckets = self.acquire(url, authorization, gated)
+            try:
+                response = send()
+            finally:
+                self.release(buckets, gated)
+            delay = self.backoff(buckets, response.status_code, response.headers, attempt)
+            if delay is None:
+                return response
+            response.close()
+            attempt += 1
+
+    async def acall(self, url, authorization, send, gated=None):
+        # async version of call; send is a coroutine function
+        if gated is None:
+            gated = self.gated(url)
+        attempt = 0
+        while True:
+            buckets = await self.acquire_async(url, authorization, gated)
+            try:
+                response = await send()
+            finally:
+                self.release(buckets, gated)
+            delay = self.backoff(buckets, response.status_code, response.headers, attempt)
+            if delay is None:
+                return response
+            attempt += 1
+
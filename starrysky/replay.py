@@ -0,0 +1,171 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+import zipfile
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Record real webui traffic to a zip archive and serve it back offline, e.g. to
+# benchmark encoding, scheduling and concurrency on a machine without a GPU.
+#
+#   api = StarrySky(baseurl=..., token=..., adapter=RecordingAdapter("run.zip"))
+#   ...
+#   api.transport.close()  # finishes the archive
+#
+#   api = StarrySky(baseurl=..., token=..., adapter=ReplayAdapter("run.zip", latency_scale=0.5))
+
+# request fields that differ on every call and must not affect matching
+VOLATILE_KEYS = ("force_task_id",)
+
+_KEPT_HEADERS = ("Content-Type", "Retry-After")
+
+
+def _request_key(method, url, body):
+    parsed = urlparse(url)
+    path = parsed.path + ("?" + parsed.query if parsed.query else "")
+    digest = ""
+    if body:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        try:
+            data = json.loads(body)
+            if isinstance(data, dict):
+                for key in VOLATILE_KEYS:
+                    data.pop(key, None)
+            body = json.dumps(data, sort_keys=True).encode("utf-8")
+        except ValueError:
+            pass
+        digest = hashlib.sha1(body).hexdigest()
+    return method.upper(), path, digest
+
+
+class TrafficArchive:
+    # zip archive (deflated) of request/response pairs:
+    #   NNNNNNNN.json  method, path, body digest, status, headers, latency
+    #   NNNNNNNN.body  response body
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "w"):
+            raise ValueError("mode must be 'r' or 'w'")
+        self.path = path
+        self.mode = mode
+        self._zip = zipfile.ZipFile(path, mode, compression=zipfile.ZIP_DEFLATED)
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def add(self, key, status, headers, latency, body):
+        method, path, digest = key
+        entry = {
+            "method": method,
+            "path": path,
+            "digest": digest,
+            "status": status,
+            "headers": {k: headers[k] for k in _KEPT_HEADERS if k in headers},
+            "latency": latency,
+        }
+        with self._lock:
+            name = f"{self._count:08}"
+            self._count += 1
+            self._zip.writestr(name + ".json", json.dumps(entry))
+            self._zip.writestr(name + ".body", body)
+
+    def entries(self):
+        names = sorted(n for n in self._zip.namelist() if n.endswith(".json"))
+        for name in names:
+            entry = json.loads(self._zip.read(name))
+            entry["body"] = self._zip.read(name[:-5] + ".body")
+            yield entry
+
+    def close(self):
+        with self._lock:
+            self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, archive, **kwargs):
+        if not isinstance(archive, TrafficArchive):
+            archive = TrafficArchive(archive, "w")
+        self.archive = archive
+        super().__init__(**kwargs)
+
+    # async calls are run through this adapter too (see StarrySky.async_post)
+    offload_async = True
+
+    def send(self, request, **kwargs):
+        start = time.monotonic()
+        response = super().send(request, **kwargs)
+        body = response.content
+        self.archive.add(
+            _request_key(request.method, request.url, request.body),
+            response.status_code,
+            response.headers,
+            time.monotonic() - start,
+            body,
+        )
+        return response
+
+    def close(self):
+        super().close()
+        self.archive.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    # Serves recorded responses. Requests are matched on method, path and
+    # payload; when the payload differs (e.g. another prompt), recordings for
+    # the same method and path are served round robin.
+    offload_async = True
+
+    def __init__(self, archive, latency_scale: float = 1.0):
+        super().__init__()
+        if not isinstance(archive, TrafficArchive):
+            archive = TrafficArchive(archive, "r")
+        self.latency_scale = latency_scale
+        self._exact = collections.defaultdict(collections.deque)
+        self._by_path = collections.defaultdict(collections.deque)
+        for entry in archive.entries():
+            key = (entry["method"], entry["path"], entry["digest"])
+            self._exact[key].append(entry)
+            self._by_path[key[:2]].append(entry)
+        archive.close()
+        self._lock = threading.Lock()
+
+    def _next(self, key):
+        with self._lock:
+            for entries in (self._exact.get(key), self._by_path.get(key[:2])):
+                if entries:
+                    entry = entries[0]
+                    entries.rotate(-1)
+                    return entry
+        return None
+
+    def send(self, request, **kwargs):
+        key = _request_key(request.method, request.url, request.body)
+        entry = self._next(key)
+        if entry is None:
+            raise requests.exceptions.ConnectionError(
+                f"no recorded response for {key[0]} {key[1]}", request=request
+            )
+        if self.latency_scale:
+            time.sleep(entry["latency"] * self.latency_scale)
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = entry["body"]
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
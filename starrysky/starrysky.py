@@ -1,12 +1,24 @@
 import json
-import requests
 import io
+import os
+import mmap
+import random
 import base64
+import binascii
+import struct
+import threading
+import time
+import uuid
+import zlib
 from PIL import Image, PngImagePlugin
 from dataclasses import dataclass
 from enum import Enum
 from typing import List, Dict, Any
 
+from .pnginfo import read_png_text, parse_generation_parameters
+from .ratelimit import RateLimiter
+from .transport import Transport, RequestsTransport
+
 
 class Upscaler(str, Enum):
     none = "None"
@@ -49,6 +61,119 @@ class StarrySkyResult:
         return self.images[0]
 
 
+@dataclass
+class PreviewFrame:
+    image: Image.Image
+    progress: float
+    eta: float  # seconds, as estimated by webui
+
+
+class RequestCancelled(RuntimeError):
+    pass
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+class BufferPool:
+    # reusable bytearrays for decode_b64_into; release() buffers once done with them
+    def __init__(self, max_buffers=16):
+        self.max_buffers = max_buffers
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self, size) -> bytearray:
+        with self._lock:
+            best = None
+            for i, buf in enumerate(self._free):
+                if len(buf) >= size and (best is None or len(buf) < len(self._free[best])):
+                    best = i
+            if best is not None:
+                return self._free.pop(best)
+        return bytearray(size)
+
+    def release(self, buf):
+        if isinstance(buf, memoryview):
+            buf = buf.obj
+        with self._lock:
+            if len(self._free) < self.max_buffers:
+                self._free.append(buf)
+
+
+_B64_CHUNK = 1 << 18  # multiple of 4
+
+
+def decode_b64_into(data, out=None, pool: BufferPool = None) -> memoryview:
+    # base64 (str or bytes-like, optionally a data: URI) -> memoryview over a
+    # bytearray, decoded chunk by chunk without an intermediate full-size copy
+    if isinstance(data, str) and data.startswith("data:"):
+        data = data[data.index(",") + 1 :]
+    if len(data) % 4 != 0:
+        # line breaks or missing padding: fall back to a plain decode
+        decoded = binascii.a2b_base64(data)
+        size = len(decoded)
+    else:
+        decoded = None
+        size = len(data) // 4 * 3
+        if len(data) and data[-1] in ("=", 61):
+            size -= 2 if data[-2] in ("=", 61) else 1
+    if out is None:
+        out = pool.acquire(size) if pool is not None else bytearray(size)
+    view = memoryview(out)
+    if len(view) < size:
+        raise ValueError(f"buffer too small: {len(view)} < {size}")
+    if decoded is not None:
+        view[:size] = decoded
+        return view[:size]
+    src = data if isinstance(data, str) else memoryview(data)
+    pos = 0
+    for start in range(0, len(data), _B64_CHUNK):
+        decoded = binascii.a2b_base64(src[start : start + _B64_CHUNK])
+        view[pos : pos + len(decoded)] = decoded
+        pos += len(decoded)
+    return view[:size]
+
+
+def fix_seed(seed) -> int:
+    # same as webui's get_fixed_seed: -1 means a random seed
+    if seed is None or seed == "" or seed == -1:
+        return random.randrange(4294967294)
+    return int(seed)
+
+
+def new_task_id() -> str:
+    return f"task({uuid.uuid4().hex})"
+
+
 class ControlNetUnit:
     def __init__(
         self,
@@ -92,7 +217,9 @@ class ControlNetUnit:
 
     def to_dict(self):
         return {
-            "input_image": raw_b64_img(self.input_image) if self.input_image else "",
+            "input_image": raw_b64_img(self.input_image)
+            if self.input_image is not None
+            else "",
             "mask": raw_b64_img(self.mask) if self.mask is not None else None,
             "module": self.module,
             "model": self.model,
@@ -110,12 +237,83 @@ class ControlNetUnit:
         }
 
 
-def b64_img(image: Image) -> str:
-    return "data:image/png;base64," + raw_b64_img(image)
+PNG_COMPRESS_LEVEL = 6  # zlib level used for numpy arrays
 
 
-def raw_b64_img(image: Image) -> str:
-    # XXX controlnet only accepts RAW base64 without headers
+def _image_mime(data) -> str:
+    head = bytes(data[:12])
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/png"
+
+
+def _png_chunk(tag: bytes, data) -> bytes:
+    crc = zlib.crc32(data, zlib.crc32(tag))
+    return struct.pack(">I", len(data)) + tag + bytes(data) + struct.pack(">I", crc)
+
+
+def _png_from_array(array) -> bytes:
+    # L/RGB/RGBA arrays straight to PNG without a PIL round trip. float arrays
+    # are taken as 0..1 and bool arrays as masks.
+    import numpy as np
+
+    array = np.asarray(array)
+    if array.dtype == np.bool_:
+        array = array.astype(np.uint8) * 255
+    elif np.issubdtype(array.dtype, np.floating):
+        array = (np.clip(array, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+    elif array.dtype != np.uint8:
+        raise ValueError(
+            f"unsupported image array dtype {array.dtype}: "
+            "use uint8 (0..255), float (0..1) or bool"
+        )
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    if array.ndim == 2:
+        color_type = 0
+    elif array.ndim == 3 and array.shape[2] in (3, 4):
+        color_type = 2 if array.shape[2] == 3 else 6
+    else:
+        return _png_bytes(Image.fromarray(array))  # e.g. LA
+
+    height, width = array.shape[:2]
+    rows = np.zeros((height, 1 + array[0].size), np.uint8)  # filter byte 0 (None)
+    rows[:, 1:] = array.reshape(height, -1)
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(rows, PNG_COMPRESS_LEVEL))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def _b64_encode_image(image):
+    # -> (mime type, raw base64). Encoded bytes and files are passed through
+    # untouched, PIL images and arrays are encoded as PNG.
+    if isinstance(image, str) and image.startswith("data:"):
+        header, data = image.split(",", 1)
+        return header[5:].split(";")[0], data
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return _image_mime(image), str(base64.b64encode(image), "utf-8")
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(f"empty image file: {image}")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return _image_mime(data), str(base64.b64encode(data), "utf-8")
+    if not isinstance(image, Image.Image):
+        return "image/png", str(base64.b64encode(_png_from_array(image)), "utf-8")
+
+    return "image/png", str(base64.b64encode(_png_bytes(image)), "utf-8")
+
+
+def _png_bytes(image: Image.Image) -> bytes:
+    # keeps text chunks such as webui's "parameters"
     with io.BytesIO() as output_bytes:
         metadata = None
         for key, value in image.info.items():
@@ -124,15 +322,149 @@ def raw_b64_img(image: Image) -> str:
                     metadata = PngImagePlugin.PngInfo()
                 metadata.add_text(key, value)
         image.save(output_bytes, format="PNG", pnginfo=metadata)
+        return output_bytes.getvalue()
+
 
-        bytes_data = output_bytes.getvalue()
+# image: PIL Image, numpy array, encoded image bytes, file path or data URI
+def b64_img(image: Image) -> str:
+    mime, data = _b64_encode_image(image)
+    return f"data:{mime};base64," + data
+
+
+def raw_b64_img(image: Image) -> str:
+    # XXX controlnet only accepts RAW base64 without headers
+    return _b64_encode_image(image)[1]
+
+
+def _normalize_model_name(name: str) -> str:
+    name = name.lower().strip()
+    if name.endswith("]") and " [" in name:
+        name = name[: name.rindex(" [")]
+    name = name.replace("\\", "/").rsplit("/", 1)[-1]
+    for ext in (".safetensors", ".ckpt", ".pt", ".bin"):
+        if name.endswith(ext):
+            name = name[: -len(ext)]
+    return name
+
+
+def _trigrams(text: str):
+    text = f"  {text} "
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class ModelIndex:
+    # lookup of sd models by title, name, file name, hash or alias, with a
+    # trigram index that narrows fuzzy matching down to a few candidates
+    def __init__(self, models, aliases=None, max_candidates=16):
+        self.models = list(models)
+        self.titles = [m["title"] for m in self.models]
+        self.max_candidates = max_candidates
+        self._exact = {}
+        self._trigrams = {}
+        self._lowered = [t.lower() for t in self.titles]
+        for i, model in enumerate(self.models):
+            keys = [model.get("title"), model.get("model_name")]
+            if model.get("filename"):
+                keys.append(model["filename"].replace("\\", "/").rsplit("/", 1)[-1])
+            for key in keys:
+                if key:
+                    self._exact.setdefault(key.lower(), i)
+                    self._exact.setdefault(_normalize_model_name(key), i)
+            for h in (model.get("hash"), model.get("sha256")):
+                if h:
+                    self._exact.setdefault(h.lower(), i)
+                    self._exact.setdefault(h.lower()[:10], i)
+            for gram in _trigrams(self._lowered[i]):
+                self._trigrams.setdefault(gram, []).append(i)
+        for alias, title in (aliases or {}).items():
+            self.add_alias(alias, title)
+
+    def add_alias(self, alias, title):
+        index = self._exact.get(title.lower())
+        if index is None:
+            raise ValueError(f"unknown model: {title}")
+        self._exact[alias.lower()] = index
+
+    def lookup(self, name):
+        index = self._exact.get(name.lower())
+        if index is None:
+            index = self._exact.get(_normalize_model_name(name))
+        return None if index is None else self.titles[index]
+
+    def closest(self, name):
+        import difflib
+
+        if not self.titles:
+            return None
+        name = name.lower()
+        counts = {}
+        for gram in _trigrams(name):
+            for i in self._trigrams.get(gram, ()):
+                counts[i] = counts.get(i, 0) + 1
+        candidates = sorted(counts, key=lambda i: -counts[i])[: self.max_candidates]
+        if not candidates:
+            candidates = range(len(self.titles))
+
+        matcher = difflib.SequenceMatcher(None, b=name)
+        best, best_sim = None, -1.0
+        for i in candidates:
+            matcher.set_seq1(self._lowered[i])
+            sim = matcher.ratio()
+            if sim > best_sim:
+                best, best_sim = i, sim
+        return self.titles[best]
+
+    def resolve(self, name, find_closest=True):
+        found = self.lookup(name)
+        if found is None and find_closest:
+            found = self.closest(name)
+        return found
+
+
+def _parse_api_result(r, raw_images=False, buffer_pool=None):
+    if raw_images:
+        # bytes-like PNG data, e.g. for numpy.frombuffer or os.write
+        decode = lambda b64: decode_b64_into(b64, pool=buffer_pool)
+    else:
+        decode = lambda b64: Image.open(io.BytesIO(base64.b64decode(b64)))
+
+    images = []
+    if "images" in r.keys():
+        images = [decode(i) for i in r["images"]]
+    elif "image" in r.keys():
+        images = [decode(r["image"])]
+
+    info = ""
+    if "info" in r.keys():
+        try:
+            info = json.loads(r["info"])
+        except:
+            info = r["info"]
+    elif "html_info" in r.keys():
+        info = r["html_info"]
+    elif "caption" in r.keys():
+        info = r["caption"]
 
-    return str(base64.b64encode(bytes_data), "utf-8")
+    parameters = ""
+    if "parameters" in r.keys():
+        parameters = r["parameters"]
 
+    return StarrySkyResult(images, parameters, info)
+
+
+def _parse_api_body(body, raw_images=False, load=False, buffer_pool=None):
+    # module level so it can run in a ProcessPoolExecutor
+    result = _parse_api_result(json.loads(body), raw_images, buffer_pool)
+    if load and not raw_images:
+        # Image.open is lazy; decode the pixels here rather than on first use
+        for image in result.images:
+            image.load()
+    return result
 
-class StarrySky:
-    has_controlnet = False
 
+class StarrySky:
+    # Instances are safe to share between threads: per-call state lives in
+    # locals, and the transport's connection pool is sized by pool_maxsize.
     def __init__(
         self,
         port=7860,
@@ -141,6 +473,16 @@ class StarrySky:
         steps=20,
         use_https=False,
         token=None,
+        pool_connections=10,  # number of hosts to keep pools for
+        pool_maxsize=10,  # connections kept alive per host, ~ number of threads
+        pool_block=False,  # wait for a free connection instead of opening extra ones
+        keep_alive=True,
+        buffer_pool: BufferPool = None,  # reused for raw_images results
+        rate_limiter: RateLimiter = None,  # can be shared between clients
+        adapter=None,  # requests transport adapter, e.g. replay.RecordingAdapter
+        transport: Transport = None,  # e.g. HttpxTransport; replaces the pool/adapter options
+        decode_executor=None,  # async results decoded here: None (loop default), thread or process pool
+        decode_offload_threshold=256 * 1024,  # response bytes; smaller ones decode inline
     ):
         if not token:
             raise ValueError("token cannot be None or empty.")
@@ -150,11 +492,39 @@ class StarrySky:
         self.baseurl = baseurl
         self.default_sampler = sampler
         self.default_steps = steps
-
-        self.session = requests.Session()
+        self.has_controlnet = False
+        self.buffer_pool = buffer_pool
+        self.decode_executor = decode_executor
+        self.decode_offload_threshold = decode_offload_threshold
+        self.model_aliases = {}
+        self._model_index = None
+
+        if transport is None:
+            transport = RequestsTransport(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block,
+                keep_alive=keep_alive,
+                adapter=adapter,
+            )
+        if rate_limiter is not None:
+            transport.rate_limiter = rate_limiter
+        self.rate_limiter = transport.rate_limiter
+        self.transport = transport
 
         self.set_auth(token)
 
+    @property
+    def session(self):
+        # the requests session of the default transport
+        session = getattr(self.transport, "session", None)
+        if session is None:
+            raise AttributeError(
+                f"{type(self.transport).__name__} has no requests session; "
+                "use api.transport (and set_basic_auth for --api-auth)"
+            )
+        return session
+
     def check_controlnet(self):
         try:
             scripts = self.get_scripts()
@@ -163,64 +533,43 @@ class StarrySky:
             pass
 
     def set_auth(self, token):
-        self.session.headers.update({"Authorization": f"Bearer {token}"})
+        self.transport.set_header("Authorization", f"Bearer {token}")
         self.check_controlnet()
 
-    def _to_api_result(self, response):
+    def set_basic_auth(self, username, password):
+        # webui's --api-auth, on any transport
+        self.transport.auth = (username, password)
+
+    def _parse_result(self, r, raw_images=False):
+        return _parse_api_result(r, raw_images, self.buffer_pool)
+
+    def _to_api_result(self, response, raw_images=False):
         if response.status_code != 200:
             raise RuntimeError(response.status_code, response.text)
 
-        r = response.json()
-        images = []
-        if "images" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(i))) for i in r["images"]]
-        elif "image" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(r["image"])))]
+        return self._parse_result(response.json(), raw_images)
 
-        info = ""
-        if "info" in r.keys():
-            try:
-                info = json.loads(r["info"])
-            except:
-                info = r["info"]
-        elif "html_info" in r.keys():
-            info = r["html_info"]
-        elif "caption" in r.keys():
-            info = r["caption"]
-
-        parameters = ""
-        if "parameters" in r.keys():
-            parameters = r["parameters"]
-
-        return StarrySkyResult(images, parameters, info)
-
-    async def _to_api_result_async(self, response):
-        if response.status != 200:
-            raise RuntimeError(response.status, await response.text())
-
-        r = await response.json()
-        images = []
-        if "images" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(i))) for i in r["images"]]
-        elif "image" in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(r["image"])))]
-
-        info = ""
-        if "info" in r.keys():
-            try:
-                info = json.loads(r["info"])
-            except:
-                info = r["info"]
-        elif "html_info" in r.keys():
-            info = r["html_info"]
-        elif "caption" in r.keys():
-            info = r["caption"]
-
-        parameters = ""
-        if "parameters" in r.keys():
-            parameters = r["parameters"]
+    async def _to_api_result_async(self, response, raw_images=False):
+        if response.status_code != 200:
+            raise RuntimeError(response.status_code, response.text)
 
-        return StarrySkyResult(images, parameters, info)
+        body = response.content
+        if len(body) < self.decode_offload_threshold:
+            return _parse_api_body(body, raw_images, buffer_pool=self.buffer_pool)
+        # json/base64/PNG decoding of large results would stall the event loop
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = self.decode_executor
+        buffer_pool = self.buffer_pool
+        if isinstance(executor, ProcessPoolExecutor):
+            buffer_pool = None
+            if raw_images:
+                executor = None  # memoryviews can't be sent between processes
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            executor, _parse_api_body, body, raw_images, True, buffer_pool
+        )
 
     def txt2img(
         self,
@@ -234,7 +583,7 @@ class StarrySky:
         hr_resize_x=0,
         hr_resize_y=0,
         prompt="",
-        styles=[],
+        styles=None,
         seed=-1,
         subseed=-1,
         subseed_strength=0.0,
@@ -257,17 +606,21 @@ class StarrySky:
         s_tmax=0,
         s_tmin=0,
         s_noise=1,
-        override_settings={},
+        override_settings=None,
         override_settings_restore_afterwards=True,
         script_args=None,  # List of arguments for the script "script_name"
         script_name=None,
         send_images=True,
         save_images=False,
-        alwayson_scripts={},
-        controlnet_units: List[ControlNetUnit] = [],
+        alwayson_scripts=None,
+        controlnet_units: List[ControlNetUnit] = None,
         sampler_index=None,  # deprecated: use sampler_name
         use_deprecated_controlnet=False,
         use_async=False,
+        timeout=None,  # seconds; the backend job is interrupted when exceeded
+        cancel_token: "CancelToken" = None,
+        raw_images=False,  # images as memoryviews of PNG bytes instead of PIL
+        task_id=None,  # webui task id (see new_task_id), for progress/interrupt
     ):
         if sampler_index is None:
             sampler_index = self.default_sampler
@@ -277,6 +630,12 @@ class StarrySky:
             steps = self.default_steps
         if script_args is None:
             script_args = []
+        if styles is None:
+            styles = []
+        if override_settings is None:
+            override_settings = {}
+        # copied: the ControlNet entry below must not leak into the caller's dict
+        alwayson_scripts = dict(alwayson_scripts or {})
         payload = {
             "enable_hr": enable_hr,
             "hr_scale": hr_scale,
@@ -320,11 +679,19 @@ class StarrySky:
             "save_images": save_images,
             "alwayson_scripts": alwayson_scripts,
         }
+        # lets us tell our job apart from others on a shared node, e.g. to
+        # interrupt it when the call times out or is cancelled
+        payload["force_task_id"] = task_id or new_task_id()
 
         if use_deprecated_controlnet and controlnet_units and len(controlnet_units) > 0:
             payload["controlnet_units"] = [x.to_dict() for x in controlnet_units]
             return self.custom_post(
-                "controlnet/txt2img", payload=payload, use_async=use_async
+                "controlnet/txt2img",
+                payload=payload,
+                use_async=use_async,
+                timeout=timeout,
+                cancel_token=cancel_token,
+                raw_images=raw_images,
             )
 
         if controlnet_units and len(controlnet_units) > 0:
@@ -336,33 +703,226 @@ class StarrySky:
             payload["alwayson_scripts"]["ControlNet"] = {"args": []}
 
         return self.post_and_get_api_result(
-            self.baseurl, payload, use_async
+            self.baseurl, payload, use_async, timeout, cancel_token, raw_images
         )
 
-    def post_and_get_api_result(self, url, json, use_async):
+    def post_and_get_api_result(
+        self, url, json, use_async, timeout=None, cancel_token=None, raw_images=False
+    ):
         if use_async:
             import asyncio
 
-            return asyncio.ensure_future(self.async_post(url=url, json=json))
-        else:
-            response = self.session.post(url=url, json=json)
-            return self._to_api_result(response)
+            return asyncio.ensure_future(
+                self.async_post(
+                    url=url,
+                    json=json,
+                    timeout=timeout,
+                    cancel_token=cancel_token,
+                    raw_images=raw_images,
+                )
+            )
 
-    async def async_post(self, url, json):
-        import aiohttp
+        task_id = json.get("force_task_id")
+        try:
+            # webui sends nothing until the job is done, so the read timeout
+            # acts as a deadline for the whole job
+            if cancel_token is None:
+                response = self.transport.post(
+                    url=url, json=json, timeout=timeout, generation=True
+                )
+            else:
+                response = self._post_cancellable(url, json, timeout, cancel_token)
+        except self.transport.timeout_errors:
+            self.abandon_task(task_id)
+            raise
+        return self._to_api_result(response, raw_images)
+
+    def _post_cancellable(self, url, json, timeout, cancel_token):
+        # the post runs on a worker thread so the caller gets RequestCancelled
+        # as soon as the token is cancelled; interrupting the backend job is
+        # best effort, and the abandoned response is closed when it arrives
+        from concurrent.futures import Future
+
+        if cancel_token.cancelled:
+            raise RequestCancelled("request cancelled before it was sent")
+        future = Future()
+        wake = threading.Event()
+
+        def post():
+            try:
+                future.set_result(
+                    self.transport.post(
+                        url=url, json=json, timeout=timeout, generation=True
+                    )
+                )
+            except BaseException as e:
+                future.set_exception(e)
+            wake.set()
+
+        def on_cancel():
+            wake.set()
+            self.abandon_task(json.get("force_task_id"))
+
+        threading.Thread(target=post, daemon=True).start()
+        cancel_token.add_callback(on_cancel)
+        try:
+            wake.wait()
+        finally:
+            cancel_token.remove_callback(on_cancel)
+        if cancel_token.cancelled:
+            future.add_done_callback(
+                lambda f: f.exception() is None and f.result().close()
+            )
+            raise RequestCancelled("request cancelled")
+        return future.result()
 
-        async with aiohttp.ClientSession() as session:
-            auth = aiohttp.BasicAuth(self.session.auth[0], self.session.auth[1]) if self.session.auth else None
-            async with session.post(url, json=json, auth=auth) as response:
-                return await self._to_api_result_async(response)
+    def _poll_preview(self, task_id, state):
+        # prefers webui's per-task progress (our job only, and only sends a
+        # preview when it changed); falls back to /progress on older servers
+        if state.get("internal", True):
+            try:
+                r = self.get_task_progress(task_id, True, state.get("id", -1))
+            except Exception:
+                r = {}
+            if "active" in r:
+                state["internal"] = True
+                preview = r.get("live_preview")
+                if not preview or r.get("id_live_preview") == state.get("id"):
+                    return None
+                state["id"] = r.get("id_live_preview")
+                image = Image.open(io.BytesIO(base64.b64decode(preview.split(",", 1)[-1])))
+                return PreviewFrame(image, r.get("progress") or 0.0, r.get("eta") or 0.0)
+            if "internal" in state:
+                return None  # it worked before; treat as a transient failure
+            state["internal"] = False
+
+        r = self.get_progress()
+        preview = r.get("current_image")
+        if not preview or preview == state.get("last"):
+            return None  # unchanged: skip the decode
+        state["last"] = preview
+        image = Image.open(io.BytesIO(base64.b64decode(preview)))
+        return PreviewFrame(image, r.get("progress", 0.0), r.get("eta_relative", 0.0))
+
+    def stream_previews(self, endpoint="txt2img", interval=0.5, **kwargs):
+        # runs txt2img/img2img and yields PreviewFrames while it renders, then
+        # the StarrySkyResult. Closing the generator early interrupts the job.
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        task_id = kwargs.pop("task_id", None) or new_task_id()
+        token = kwargs.pop("cancel_token", None) or CancelToken()
+        call = getattr(self, endpoint)
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(call, task_id=task_id, cancel_token=token, **kwargs)
+        state = {}
+        try:
+            while not future.done():
+                frame = self._poll_preview(task_id, state)
+                if frame is not None:
+                    yield frame
+                wait([future], timeout=interval)
+            yield future.result()
+        finally:
+            if not future.done():
+                token.cancel()
+            executor.shutdown(wait=False)
+
+    async def astream_previews(self, endpoint="txt2img", interval=0.5, **kwargs):
+        # async version of stream_previews
+        import asyncio
+
+        task_id = kwargs.pop("task_id", None) or new_task_id()
+        call = getattr(self, endpoint)
+        task = call(use_async=True, task_id=task_id, **kwargs)
+        loop = asyncio.get_event_loop()
+        state = {}
+        try:
+            while not task.done():
+                frame = await loop.run_in_executor(
+                    None, self._poll_preview, task_id, state
+                )
+                if frame is not None:
+                    yield frame
+                await asyncio.wait([task], timeout=interval)
+            yield task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+
+    async def async_post(
+        self, url, json, timeout=None, cancel_token=None, raw_images=False
+    ):
+        import asyncio
+
+        task_id = json.get("force_task_id")
+        on_cancel = None
+        if cancel_token is not None:
+            if cancel_token.cancelled:
+                raise RequestCancelled("request cancelled before it was sent")
+            loop = asyncio.get_event_loop()
+            task = asyncio.current_task()
+            on_cancel = lambda: loop.call_soon_threadsafe(task.cancel)
+            cancel_token.add_callback(on_cancel)
+
+        try:
+            response = await self.transport.apost(
+                url=url, json=json, timeout=timeout, generation=True
+            )
+            return await self._to_api_result_async(response, raw_images)
+        except (asyncio.TimeoutError,) + self.transport.timeout_errors:
+            self.abandon_task(task_id)
+            raise
+        except asyncio.CancelledError:
+            self.abandon_task(task_id)
+            if cancel_token is not None and cancel_token.cancelled:
+                raise RequestCancelled("request cancelled")
+            raise
+        finally:
+            if on_cancel is not None:
+                cancel_token.remove_callback(on_cancel)
+
+    def get_task_progress(self, task_id, live_preview=False, id_live_preview=-1):
+        payload = {
+            "id_task": task_id,
+            "id_live_preview": id_live_preview,
+            "live_preview": live_preview,
+        }
+        response = self.transport.post(
+            url=self.get_endpoint("internal/progress", False), json=payload
+        )
+        return response.json()
+
+    def interrupt_task(self, task_id, queued_timeout=60.0, check_interval=0.5):
+        # only interrupt while webui reports our task as the running job, so a
+        # shared node doesn't lose someone else's work. a queued task is
+        # watched until it starts (or queued_timeout passes).
+        deadline = time.monotonic() + queued_timeout
+        while True:
+            try:
+                state = self.get_task_progress(task_id)
+            except Exception:
+                return False
+            if state.get("active"):
+                self.interrupt()
+                return True
+            if not state.get("queued") or time.monotonic() > deadline:
+                return False
+            time.sleep(check_interval)
+
+    def abandon_task(self, task_id):
+        if task_id is None:
+            return
+        threading.Thread(
+            target=self.interrupt_task, args=(task_id,), daemon=True
+        ).start()
 
     def img2img(
         self,
-        images=[],  # list of PIL Image
+        images=None,  # list of PIL Images, numpy arrays, bytes or file paths
         resize_mode=0,
         denoising_strength=0.75,
         image_cfg_scale=1.5,
-        mask_image=None,  # PIL Image mask
+        mask_image=None,  # mask, same types as images
         mask_blur=4,
         inpainting_fill=0,
         inpaint_full_res=True,
@@ -370,7 +930,7 @@ class StarrySky:
         inpainting_mask_invert=0,
         initial_noise_multiplier=1,
         prompt="",
-        styles=[],
+        styles=None,
         seed=-1,
         subseed=-1,
         subseed_strength=0,
@@ -393,7 +953,7 @@ class StarrySky:
         s_tmax=0,
         s_tmin=0,
         s_noise=1,
-        override_settings={},
+        override_settings=None,
         override_settings_restore_afterwards=True,
         script_args=None,  # List of arguments for the script "script_name"
         sampler_index=None,  # deprecated: use sampler_name
@@ -401,10 +961,14 @@ class StarrySky:
         script_name=None,
         send_images=True,
         save_images=False,
-        alwayson_scripts={},
-        controlnet_units: List[ControlNetUnit] = [],
+        alwayson_scripts=None,
+        controlnet_units: List[ControlNetUnit] = None,
         use_deprecated_controlnet=False,
         use_async=False,
+        timeout=None,  # seconds; the backend job is interrupted when exceeded
+        cancel_token: "CancelToken" = None,
+        raw_images=False,  # images as memoryviews of PNG bytes instead of PIL
+        task_id=None,  # webui task id (see new_task_id), for progress/interrupt
     ):
         if sampler_name is None:
             sampler_name = self.default_sampler
@@ -414,9 +978,15 @@ class StarrySky:
             steps = self.default_steps
         if script_args is None:
             script_args = []
+        if styles is None:
+            styles = []
+        if override_settings is None:
+            override_settings = {}
+        # copied: the ControlNet entry below must not leak into the caller's dict
+        alwayson_scripts = dict(alwayson_scripts or {})
 
         payload = {
-            "init_images": [b64_img(x) for x in images],
+            "init_images": [b64_img(x) for x in images or []],
             "resize_mode": resize_mode,
             "denoising_strength": denoising_strength,
             "mask_blur": mask_blur,
@@ -462,11 +1032,17 @@ class StarrySky:
         }
         if mask_image is not None:
             payload["mask"] = b64_img(mask_image)
+        payload["force_task_id"] = task_id or new_task_id()
 
         if use_deprecated_controlnet and controlnet_units and len(controlnet_units) > 0:
             payload["controlnet_units"] = [x.to_dict() for x in controlnet_units]
             return self.custom_post(
-                "controlnet/img2img", payload=payload, use_async=use_async
+                "controlnet/img2img",
+                payload=payload,
+                use_async=use_async,
+                timeout=timeout,
+                cancel_token=cancel_token,
+                raw_images=raw_images,
             )
 
         if controlnet_units and len(controlnet_units) > 0:
@@ -477,12 +1053,12 @@ class StarrySky:
             payload["alwayson_scripts"]["ControlNet"] = {"args": []}
 
         return self.post_and_get_api_result(
-            f"{self.baseurl}/img2img", payload, use_async
+            f"{self.baseurl}/img2img", payload, use_async, timeout, cancel_token, raw_images
         )
 
     def extra_single_image(
         self,
-        image,  # PIL Image
+        image,  # PIL Image, numpy array, bytes or file path
         resize_mode=0,
         show_extras_results=True,
         gfpgan_visibility=0,
@@ -497,6 +1073,8 @@ class StarrySky:
         extras_upscaler_2_visibility=0,
         upscale_first=False,
         use_async=False,
+        timeout=None,  # client-side only: extras jobs have no task id to interrupt
+        raw_images=False,
     ):
         payload = {
             "resize_mode": resize_mode,
@@ -516,12 +1094,12 @@ class StarrySky:
         }
 
         return self.post_and_get_api_result(
-            f"{self.baseurl}/extra-single-image", payload, use_async
+            f"{self.baseurl}/extra-single-image", payload, use_async, timeout, None, raw_images
         )
 
     def extra_batch_images(
         self,
-        images,  # list of PIL images
+        images,  # list of PIL Images, numpy arrays, bytes or file paths
         name_list=None,  # list of image names
         resize_mode=0,
         show_extras_results=True,
@@ -537,6 +1115,8 @@ class StarrySky:
         extras_upscaler_2_visibility=0,
         upscale_first=False,
         use_async=False,
+        timeout=None,  # client-side only: extras jobs have no task id to interrupt
+        raw_images=False,
     ):
         if name_list is not None:
             if len(name_list) != len(images):
@@ -567,16 +1147,22 @@ class StarrySky:
         }
 
         return self.post_and_get_api_result(
-            f"{self.baseurl}/extra-batch-images", payload, use_async
+            f"{self.baseurl}/extra-batch-images", payload, use_async, timeout, None, raw_images
         )
 
-    # XXX 500 error (2022/12/26)
-    def png_info(self, image):
+    # XXX remote /png-info: 500 error (2022/12/26)
+    def png_info(self, image, local=True):
+        if local:
+            # read the text chunks locally: no upload, no pixel decode
+            text = read_png_text(image).get("parameters", "")
+            parameters = parse_generation_parameters(text) if text else {}
+            return StarrySkyResult([], parameters, text)
+
         payload = {
             "image": b64_img(image),
         }
 
-        response = self.session.post(url=f"{self.baseurl}/png-info", json=payload)
+        response = self.transport.post(url=f"{self.baseurl}/png-info", json=payload)
         return self._to_api_result(response)
 
     # XXX always returns empty info (2022/12/26)
@@ -585,99 +1171,100 @@ class StarrySky:
             "image": b64_img(image),
         }
 
-        response = self.session.post(url=f"{self.baseurl}/interrogate", json=payload)
+        response = self.transport.post(url=f"{self.baseurl}/interrogate", json=payload)
         return self._to_api_result(response)
 
     def interrupt(self):
-        response = self.session.post(url=f"{self.baseurl}/interrupt")
+        response = self.transport.post(url=f"{self.baseurl}/interrupt")
         return response.json()
 
     def skip(self):
-        response = self.session.post(url=f"{self.baseurl}/skip")
+        response = self.transport.post(url=f"{self.baseurl}/skip")
         return response.json()
 
     def get_options(self):
-        response = self.session.get(url=f"{self.baseurl}/options")
+        response = self.transport.get(url=f"{self.baseurl}/options")
         return response.json()
 
     def set_options(self, options):
-        response = self.session.post(url=f"{self.baseurl}/options", json=options)
+        response = self.transport.post(url=f"{self.baseurl}/options", json=options)
         return response.json()
 
     def get_cmd_flags(self):
-        response = self.session.get(url=f"{self.baseurl}/cmd-flags")
+        response = self.transport.get(url=f"{self.baseurl}/cmd-flags")
         return response.json()
 
     def get_progress(self):
-        response = self.session.get(url=f"{self.baseurl}/progress")
+        response = self.transport.get(url=f"{self.baseurl}/progress")
         return response.json()
 
     def get_cmd_flags(self):
-        response = self.session.get(url=f"{self.baseurl}/cmd-flags")
+        response = self.transport.get(url=f"{self.baseurl}/cmd-flags")
         return response.json()
 
     def get_samplers(self):
-        response = self.session.get(url=f"{self.baseurl}/samplers")
+        response = self.transport.get(url=f"{self.baseurl}/samplers")
         return response.json()
 
     def get_sd_vae(self):
-        response = self.session.get(url=f"{self.baseurl}/sd-vae")
+        response = self.transport.get(url=f"{self.baseurl}/sd-vae")
         return response.json()
 
     def get_upscalers(self):
-        response = self.session.get(url=f"{self.baseurl}/upscalers")
+        response = self.transport.get(url=f"{self.baseurl}/upscalers")
         return response.json()
 
     def get_latent_upscale_modes(self):
-        response = self.session.get(url=f"{self.baseurl}/latent-upscale-modes")
+        response = self.transport.get(url=f"{self.baseurl}/latent-upscale-modes")
         return response.json()
 
     def get_loras(self):
-        response = self.session.get(url=f"{self.baseurl}/loras")
+        response = self.transport.get(url=f"{self.baseurl}/loras")
         return response.json()
 
     def get_sd_models(self):
-        response = self.session.get(url=f"{self.baseurl}/sd-models")
+        response = self.transport.get(url=f"{self.baseurl}/sd-models")
         return response.json()
 
     def get_hypernetworks(self):
-        response = self.session.get(url=f"{self.baseurl}/hypernetworks")
+        response = self.transport.get(url=f"{self.baseurl}/hypernetworks")
         return response.json()
 
     def get_face_restorers(self):
-        response = self.session.get(url=f"{self.baseurl}/face-restorers")
+        response = self.transport.get(url=f"{self.baseurl}/face-restorers")
         return response.json()
 
     def get_realesrgan_models(self):
-        response = self.session.get(url=f"{self.baseurl}/realesrgan-models")
+        response = self.transport.get(url=f"{self.baseurl}/realesrgan-models")
         return response.json()
 
     def get_prompt_styles(self):
-        response = self.session.get(url=f"{self.baseurl}/prompt-styles")
+        response = self.transport.get(url=f"{self.baseurl}/prompt-styles")
         return response.json()
 
     def get_artist_categories(self):  # deprecated ?
-        response = self.session.get(url=f"{self.baseurl}/artist-categories")
+        response = self.transport.get(url=f"{self.baseurl}/artist-categories")
         return response.json()
 
     def get_artists(self):  # deprecated ?
-        response = self.session.get(url=f"{self.baseurl}/artists")
+        response = self.transport.get(url=f"{self.baseurl}/artists")
         return response.json()
 
     def refresh_checkpoints(self):
-        response = self.session.post(url=f"{self.baseurl}/refresh-checkpoints")
+        response = self.transport.post(url=f"{self.baseurl}/refresh-checkpoints")
+        self._model_index = None
         return response.json()
 
     def get_scripts(self):
-        response = self.session.get(url=f"{self.baseurl}/scripts")
+        response = self.transport.get(url=f"{self.baseurl}/scripts")
         return response.json()
 
     def get_embeddings(self):
-        response = self.session.get(url=f"{self.baseurl}/embeddings")
+        response = self.transport.get(url=f"{self.baseurl}/embeddings")
         return response.json()
 
     def get_memory(self):
-        response = self.session.get(url=f"{self.baseurl}/memory")
+        response = self.transport.get(url=f"{self.baseurl}/memory")
         return response.json()
 
     def get_endpoint(self, endpoint, baseurl):
@@ -693,18 +1280,25 @@ class StarrySky:
 
     def custom_get(self, endpoint, baseurl=False):
         url = self.get_endpoint(endpoint, baseurl)
-        response = self.session.get(url=url)
+        response = self.transport.get(url=url)
         return response.json()
 
-    def custom_post(self, endpoint, payload={}, baseurl=False, use_async=False):
+    def custom_post(
+        self,
+        endpoint,
+        payload=None,
+        baseurl=False,
+        use_async=False,
+        timeout=None,
+        cancel_token=None,
+        raw_images=False,
+    ):
         url = self.get_endpoint(endpoint, baseurl)
-        if use_async:
-            import asyncio
-
-            return asyncio.ensure_future(self.async_post(url=url, json=payload))
-        else:
-            response = self.session.post(url=url, json=payload)
-            return self._to_api_result(response)
+        if payload is None:
+            payload = {}
+        return self.post_and_get_api_result(
+            url, payload, use_async, timeout, cancel_token, raw_images
+        )
 
     def controlnet_version(self):
         r = self.custom_get("controlnet/version")
@@ -732,30 +1326,33 @@ class StarrySky:
         r = self.custom_post("controlnet/detect", payload=payload)
         return r
 
+    def util_get_model_index(self, refresh=False) -> ModelIndex:
+        # cached until refresh_checkpoints() (or refresh=True)
+        index = self._model_index
+        if index is None or refresh:
+            index = ModelIndex(self.get_sd_models(), aliases=self.model_aliases)
+            self._model_index = index
+        return index
+
+    def util_add_model_alias(self, alias, name):
+        title = self.util_get_model_index().resolve(name, find_closest=False)
+        if title is None:
+            raise ValueError(f"unknown model: {name}")
+        self.model_aliases[alias] = title
+        self.util_get_model_index().add_alias(alias, title)
+
     def util_get_model_names(self):
-        return sorted([x["title"] for x in self.get_sd_models()])
-
-    def util_set_model(self, name, find_closest=True):
-        if find_closest:
-            name = name.lower()
-        models = self.util_get_model_names()
-        found_model = None
-        if name in models:
-            found_model = name
-        elif find_closest:
-            import difflib
-
-            def str_simularity(a, b):
-                return difflib.SequenceMatcher(None, a, b).ratio()
-
-            max_sim = 0.0
-            max_model = models[0]
-            for model in models:
-                sim = str_simularity(name, model)
-                if sim >= max_sim:
-                    max_sim = sim
-                    max_model = model
-            found_model = max_model
+        return sorted(self.util_get_model_index().titles)
+
+    def util_set_model(self, name, find_closest=True, force=False):
+        index = self.util_get_model_index()
+        found_model = index.resolve(name, find_closest)
+        if found_model and not force:
+            current = self.util_get_current_model()
+            if index.resolve(current, find_closest=False) == found_model:
+                # set_options would reload the checkpoint for nothing
+                print(f"{found_model} already loaded")
+                return
         if found_model:
             print(f"loading {found_model}")
             options = {}
@@ -768,6 +1365,57 @@ class StarrySky:
     def util_get_current_model(self):
         return self.get_options()["sd_model_checkpoint"]
 
+    def iterate(self, endpoint="txt2img", backends=None, **kwargs):
+        # Runs a txt2img/img2img with n_iter as one request per iteration and
+        # yields each StarrySkyResult as soon as it's done. Seeds are fixed the
+        # way webui assigns them, so images match the single request (apart
+        # from the grid). With backends (StarrySky list) iterations run in
+        # parallel and are yielded in completion order.
+        n_iter = kwargs.pop("n_iter", 1)
+        batch_size = kwargs.get("batch_size", 1)
+        seed = fix_seed(kwargs.get("seed", -1))
+        subseed = fix_seed(kwargs.get("subseed", -1))
+        seed_step = 0 if kwargs.get("subseed_strength") else 1
+
+        def iteration_kwargs(n):
+            sub = dict(kwargs)
+            sub["n_iter"] = 1
+            sub["seed"] = seed + n * batch_size * seed_step
+            sub["subseed"] = subseed + n * batch_size
+            return sub
+
+        errors = []
+        if not backends:
+            for n in range(n_iter):
+                try:
+                    yield getattr(self, endpoint)(**iteration_kwargs(n))
+                except Exception as e:
+                    errors.append(e)
+        else:
+            from concurrent.futures import ThreadPoolExecutor, as_completed
+            from .pipeline import BackendScheduler
+
+            scheduler = BackendScheduler(backends, max_in_flight=1)
+
+            def run(n):
+                with scheduler.backend() as api:
+                    return getattr(api, endpoint)(**iteration_kwargs(n))
+
+            with ThreadPoolExecutor(max_workers=scheduler.capacity) as executor:
+                futures = [executor.submit(run, n) for n in range(n_iter)]
+                try:
+                    for future in as_completed(futures):
+                        try:
+                            yield future.result()
+                        except Exception as e:
+                            errors.append(e)
+                finally:
+                    for future in futures:
+                        future.cancel()
+        if errors:
+            # the other iterations were still delivered
+            raise errors[0]
+
     def util_wait_for_ready(self, check_interval=5.0):
         import time
 
@@ -814,7 +1462,7 @@ class InstructPix2PixInterface:
 
     def img2img(
         self,
-        images=[],
+        images=None,
         prompt: str = "",
         negative_prompt: str = "",
         output_batches: int = 1,
@@ -827,6 +1475,8 @@ class InstructPix2PixInterface:
         randomize_cfg: bool = False,
         output_image_width: int = 512,
     ):
+        if images is None:
+            images = []
         init_images = [b64_img(x) for x in images]
         payload = {
             "init_images": init_images,
@@ -860,8 +1510,8 @@ class ControlNetInterface:
         self,
         prompt: str = "",
         negative_prompt: str = "",
-        controlnet_input_image: [] = [],
-        controlnet_mask: [] = [],
+        controlnet_input_image: list = None,
+        controlnet_mask: list = None,
         controlnet_module: str = "",
         controlnet_model: str = "",
         controlnet_weight: float = 0.5,
@@ -892,6 +1542,10 @@ class ControlNetInterface:
     ):
         if self.show_deprecation_warning:
             self.print_deprecation_warning()
+        if controlnet_input_image is None:
+            controlnet_input_image = []
+        if controlnet_mask is None:
+            controlnet_mask = []
 
         controlnet_input_image_b64 = [raw_b64_img(x) for x in controlnet_input_image]
         controlnet_mask_b64 = [raw_b64_img(x) for x in controlnet_mask]
@@ -933,7 +1587,7 @@ class ControlNetInterface:
 
     def img2img(
         self,
-        init_images: [] = [],
+        init_images: list = None,
         mask: str = None,
         mask_blur: int = 30,
         inpainting_fill: int = 0,
@@ -944,8 +1598,8 @@ class ControlNetInterface:
         denoising_strength: float = 0.7,
         prompt: str = "",
         negative_prompt: str = "",
-        controlnet_input_image: [] = [],
-        controlnet_mask: [] = [],
+        controlnet_input_image: list = None,
+        controlnet_mask: list = None,
         controlnet_module: str = "",
         controlnet_model: str = "",
         controlnet_weight: float = 1.0,
@@ -973,6 +1627,12 @@ class ControlNetInterface:
     ):
         if self.show_deprecation_warning:
             self.print_deprecation_warning()
+        if init_images is None:
+            init_images = []
+        if controlnet_input_image is None:
+            controlnet_input_image = []
+        if controlnet_mask is None:
+            controlnet_mask = []
 
         init_images_b64 = [raw_b64_img(x) for x in init_images]
         controlnet_input_image_b64 = [raw_b64_img(x) for x in controlnet_input_image]
@@ -980,7 +1640,7 @@ class ControlNetInterface:
 
         payload = {
             "init_images": init_images_b64,
-            "mask": raw_b64_img(mask) if mask else None,
+            "mask": raw_b64_img(mask) if mask is not None else None,
             "mask_blur": mask_blur,
             "inpainting_fill": inpainting_fill,
             "inpaint_full_res": inpaint_full_res,
@@ -0,0 +1,263 @@
+import asyncio
+import json as jsonlib
+import threading
+import weakref
+
+import requests
+
+from .ratelimit import RateLimiter
+
+# HTTP clients used by StarrySky for every call, sync and async. Responses have
+# status_code, headers, content, text and json() (requests/httpx responses, or
+# Response for bodies read by aiohttp).
+#
+#   api = StarrySky(baseurl=..., token=..., transport=HttpxTransport(http2=True))
+
+
+class Response:
+    # a fully read response
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return jsonlib.loads(self.content)
+
+    def close(self):
+        pass
+
+
+class Transport:
+    timeout_errors = ()  # raised when a request's timeout passes
+
+    def __init__(self, rate_limiter: RateLimiter = None, headers=None, auth=None):
+        self.rate_limiter = rate_limiter
+        self.headers = dict(headers or {})
+        self.auth = auth  # (username, password) for webui's --api-auth
+
+    def set_header(self, name, value):
+        # swap in a new dict so concurrent requests never see it mid-update
+        headers = dict(self.headers)
+        headers[name] = value
+        self.headers = headers
+
+    # generation: the request runs a job (txt2img, img2img, extras) and counts
+    # towards the rate limiter's max_concurrent; None guesses from the url
+    def request(self, method, url, json=None, timeout=None, generation=None):
+        headers = self.headers
+        send = lambda: self._send(method, url, json, headers, timeout)
+        if self.rate_limiter is None:
+            return send()
+        return self.rate_limiter.call(
+            url, headers.get("Authorization"), send, generation
+        )
+
+    async def arequest(self, method, url, json=None, timeout=None, generation=None):
+        headers = self.headers
+        send = lambda: self._asend(method, url, json, headers, timeout)
+        if self.rate_limiter is None:
+            return await send()
+        return await self.rate_limiter.acall(
+            url, headers.get("Authorization"), send, generation
+        )
+
+    def get(self, url, timeout=None):
+        return self.request("GET", url, timeout=timeout)
+
+    def post(self, url, json=None, timeout=None, generation=None):
+        return self.request(
+            "POST", url, json=json, timeout=timeout, generation=generation
+        )
+
+    async def aget(self, url, timeout=None):
+        return await self.arequest("GET", url, timeout=timeout)
+
+    async def apost(self, url, json=None, timeout=None, generation=None):
+        return await self.arequest(
+            "POST", url, json=json, timeout=timeout, generation=generation
+        )
+
+    def _send(self, method, url, json, headers, timeout):
+        raise NotImplementedError
+
+    async def _asend(self, method, url, json, headers, timeout):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    # requests session (HTTP/1.1) for sync calls, aiohttp for async ones
+    timeout_errors = (requests.exceptions.Timeout,)
+
+    def __init__(
+        self,
+        pool_connections=10,  # number of hosts to keep pools for
+        pool_maxsize=10,  # connections kept alive per host, ~ number of threads
+        pool_block=False,  # wait for a free connection instead of opening extra ones
+        keep_alive=True,
+        adapter=None,  # requests transport adapter, e.g. replay.RecordingAdapter
+        rate_limiter: RateLimiter = None,
+        headers=None,
+        auth=None,
+    ):
+        self.session = requests.Session()
+        super().__init__(rate_limiter, headers, auth)
+        if adapter is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block,
+            )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if not keep_alive:
+            self.set_header("Connection", "close")
+
+    @property
+    def auth(self):
+        # kept on the session, so setting session.auth directly also works
+        return self.session.auth
+
+    @auth.setter
+    def auth(self, auth):
+        self.session.auth = auth
+
+    def _send(self, method, url, json, headers, timeout):
+        return self.session.request(
+            method, url, json=json, headers=headers, timeout=timeout
+        )
+
+    async def _asend(self, method, url, json, headers, timeout):
+        if getattr(self.session.get_adapter(url), "offload_async", False):
+            # recording/replay adapters only hook the requests session
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                None, self._send, method, url, json, headers, timeout
+            )
+
+        import aiohttp
+
+        auth = None
+        if self.auth:
+            auth = aiohttp.BasicAuth(self.auth[0], self.auth[1])
+            # as with requests and httpx, basic auth replaces the token header
+            headers = {k: v for k, v in headers.items() if k.lower() != "authorization"}
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with aiohttp.ClientSession(timeout=client_timeout) as session:
+            async with session.request(
+                method, url, json=json, headers=headers, auth=auth
+            ) as response:
+                content = await response.read()
+                return Response(response.status, response.headers, content)
+
+    def close(self):
+        self.session.close()
+
+
+class HttpxTransport(Transport):
+    # httpx clients for sync and async calls. With http2=True (needs the h2
+    # package) requests to a host share one multiplexed connection, so small
+    # /progress polls aren't queued behind running jobs. Request bodies of
+    # http1_upload_threshold bytes or more are sent over a separate HTTP/1.1
+    # pool: HTTP/2 flow control makes large uploads on a shared connection slow.
+    def __init__(
+        self,
+        http2=True,
+        max_connections=100,
+        max_keepalive_connections=20,
+        http1_upload_threshold=512 * 1024,  # None: everything over HTTP/2
+        rate_limiter: RateLimiter = None,
+        headers=None,
+        auth=None,
+        **client_options,  # passed to httpx.Client/AsyncClient, e.g. verify
+    ):
+        import httpx
+
+        super().__init__(rate_limiter, headers, auth)
+        self.timeout_errors = (httpx.TimeoutException,)
+        self.http2 = http2
+        self.http1_upload_threshold = http1_upload_threshold
+        self._options = dict(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+            **client_options,
+        )
+        self._httpx = httpx
+        self.client, self.upload_client = self._clients(httpx.Client)
+        # async clients are bound to the event loop they were created on
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _clients(self, client_class):
+        # -> (client, client for large uploads)
+        client = client_class(http2=self.http2, **self._options)
+        if not self.http2 or self.http1_upload_threshold is None:
+            return client, client
+        return client, client_class(http2=False, **self._options)
+
+    def _prepare(self, clients, json, headers):
+        # -> (client, body, headers)
+        if json is None:
+            return clients[0], None, headers
+        content = jsonlib.dumps(json).encode("utf-8")
+        headers = dict(headers)
+        headers["Content-Type"] = "application/json"
+        threshold = self.http1_upload_threshold
+        if threshold is not None and len(content) >= threshold:
+            return clients[1], content, headers
+        return clients[0], content, headers
+
+    def _send(self, method, url, json, headers, timeout):
+        client, content, headers = self._prepare(
+            (self.client, self.upload_client), json, headers
+        )
+        # timeout=None disables httpx's default 5s timeout, like requests
+        return client.request(
+            method,
+            url,
+            content=content,
+            headers=headers,
+            auth=self.auth,
+            timeout=timeout,
+        )
+
+    def async_clients(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._async_clients.get(loop)
+            if clients is None:
+                clients = self._async_clients[loop] = self._clients(
+                    self._httpx.AsyncClient
+                )
+            return clients
+
+    async def _asend(self, method, url, json, headers, timeout):
+        client, content, headers = self._prepare(self.async_clients(), json, headers)
+        return await client.request(
+            method,
+            url,
+            content=content,
+            headers=headers,
+            auth=self.auth,
+            timeout=timeout,
+        )
+
+    async def aclose(self):
+        # closes the async clients of the running event loop
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), ())
+        for client in set(clients):
+            await client.aclose()
+
+    def close(self):
+        for client in {self.client, self.upload_client}:
+            client.close()